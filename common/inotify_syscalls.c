@@ -20,8 +20,21 @@
   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
   THE SOFTWARE.
 */
+#define PY_SSIZE_T_CLEAN
 #include <sys/syscall.h>
 #include <Python.h>
+#include <string.h>
+
+#if PY_VERSION_HEX < 0x02050000
+typedef int Py_ssize_t;
+#endif
+
+/* Format unit of a bytes string (str on python 2). */
+#if PY_MAJOR_VERSION < 3
+# define BYTES_FMT "s#"
+#else
+# define BYTES_FMT "y#"
+#endif
 
 #if (defined(__NR_inotify_init) && defined(__NR_inotify_add_watch) &&   \
      defined(__NR_inotify_rm_watch))
@@ -163,10 +176,70 @@ static PyObject* inotify_rm_watch(PyObject* self, PyObject* args) {
   return Py_BuildValue("i", result);
 }
 
+/* Header of struct inotify_event, the name follows it. */
+struct raw_event_header {
+  int wd;
+  unsigned int mask;
+  unsigned int cookie;
+  unsigned int len;
+};
+
+static PyObject* parse_events(PyObject* self, PyObject* args) {
+  const char* buf = NULL;
+  Py_ssize_t size = 0;
+  Py_ssize_t offset = 0;
+  PyObject* events = NULL;
+  PyObject* event = NULL;
+  struct raw_event_header header;
+  size_t name_len = 0;
+
+  if (!PyArg_ParseTuple(args, BYTES_FMT, &buf, &size))
+    return NULL;
+
+  events = PyList_New(0);
+  if (events == NULL)
+    return NULL;
+
+  while (offset + (Py_ssize_t) sizeof(header) <= size) {
+    memcpy(&header, buf + offset, sizeof(header));
+    offset += sizeof(header);
+    if (offset + (Py_ssize_t) header.len > size) {
+      PyErr_SetString(PyExc_ValueError, "truncated inotify event");
+      Py_DECREF(events);
+      return NULL;
+    }
+    /* The name is padded with trailing null bytes. */
+    name_len = 0;
+    while (name_len < header.len && buf[offset + name_len] != '\0')
+      name_len++;
+    event = Py_BuildValue("(iII" BYTES_FMT ")", header.wd, header.mask,
+                          header.cookie, buf + offset,
+                          (Py_ssize_t) name_len);
+    if (event == NULL || PyList_Append(events, event) == -1) {
+      Py_XDECREF(event);
+      Py_DECREF(events);
+      return NULL;
+    }
+    Py_DECREF(event);
+    offset += header.len;
+  }
+
+  if (offset != size) {
+    /* Trailing partial header. */
+    PyErr_SetString(PyExc_ValueError, "truncated inotify event");
+    Py_DECREF(events);
+    return NULL;
+  }
+
+  return events;
+}
+
 static PyMethodDef inotify_syscalls_functions[] = {
   {"inotify_init", inotify_init, METH_VARARGS, "inotify initialization"},
   {"inotify_add_watch", inotify_add_watch, METH_VARARGS, "Add a new watch"},
   {"inotify_rm_watch", inotify_rm_watch, METH_VARARGS, "Remove a watch"},
+  {"parse_events", parse_events, METH_VARARGS,
+   "Parse a buffer of events into a list of (wd, mask, cookie, name)"},
   {0}
 };
 
@@ -20,7 +20,7 @@ import pyinotify
 class OnWriteHandler(pyinotify.ProcessEvent):
     def my_init(self, cwd, extension, cmd):
         self.cwd = cwd
-        self.extensions = extension.split(',')
+        self.extensions = tuple(extension.split(','))
         self.cmd = cmd
 
     def _run_cmd(self):
@@ -28,7 +28,7 @@ class OnWriteHandler(pyinotify.ProcessEvent):
         subprocess.call(self.cmd.split(' '), cwd=self.cwd)
 
     def process_IN_MODIFY(self, event):
-        if all(not event.pathname.endswith(ext) for ext in self.extensions):
+        if not event.pathname.endswith(self.extensions):
             return
         self._run_cmd()
 
@@ -12,7 +12,13 @@ class Log(pyinotify.ProcessEvent):
         self._fileobj = fileobj
 
     def process_default(self, event):
+        # Flushed once per batch of events, see flush_log().
         self._fileobj.write(str(event) + '\n')
+
+    def flush_log(self, notifier):
+        """
+        Loop callback, flushes the events logged during the last batch.
+        """
         self._fileobj.flush()
 
 class TrackModifications(pyinotify.ProcessEvent):
@@ -28,13 +34,14 @@ class Empty(pyinotify.ProcessEvent):
 
 
 # pyinotify.log.setLevel(10)
-fo = file('/var/log/pyinotify_log', 'w')
+fo = open('/var/log/pyinotify_log', 'w')
 try:
     wm = pyinotify.WatchManager()
     # It is important to pass named extra arguments like 'fileobj'.
-    handler = Empty(TrackModifications(Log(fileobj=fo)), msg='Outer chained method')
+    log_handler = Log(fileobj=fo)
+    handler = Empty(TrackModifications(log_handler), msg='Outer chained method')
     notifier = pyinotify.Notifier(wm, default_proc_fun=handler)
     wm.add_watch('/tmp', pyinotify.ALL_EVENTS)
-    notifier.loop()
+    notifier.loop(callback=log_handler.flush_log)
 finally:
     fo.close()
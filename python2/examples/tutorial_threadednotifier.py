@@ -20,6 +20,7 @@ notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
 notifier.start()
 
 wdd = wm.add_watch('/tmp', mask, rec=True)
-wm.rm_watch(wdd.values())
 
+# Closing the inotify instance in stop() releases all its watches, there
+# is no need to call wm.rm_watch(wdd.values()) first.
 notifier.stop()
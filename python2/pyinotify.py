@@ -64,11 +64,10 @@ import array
 import logging
 import atexit
 from collections import deque
-from datetime import datetime, timedelta
 import time
 import re
+import bisect
 import asyncore
-import subprocess
 
 try:
     from functools import reduce
@@ -92,6 +91,54 @@ try:
 except ImportError:
     inotify_syscalls = None
 
+try:
+    # Optional backport of Python 3.5's os.scandir().
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+def _parse_events_py(buf):
+    """
+    Parse a buffer read from the inotify file descriptor.
+
+    @param buf: Raw content read from the inotify file descriptor.
+    @type buf: str
+    @return: List of (wd, mask, cookie, name) tuples.
+    @rtype: list
+    @raise ValueError: If buf ends with a truncated event.
+    """
+    events = []
+    size = len(buf)
+    s_size = 16
+    rsum = 0  # counter
+    while rsum + s_size <= size:
+        # Retrieve wd, mask, cookie and fname_len
+        wd, mask, cookie, fname_len = struct.unpack('iIII',
+                                                    buf[rsum:rsum+s_size])
+        rsum += s_size
+        if rsum + fname_len > size:
+            raise ValueError('truncated inotify event')
+        # Retrieve name, without its trailing '\0' padding
+        fname = buf[rsum:rsum + fname_len].rstrip('\0')
+        events.append((wd, mask, cookie, fname))
+        rsum += fname_len
+    if rsum != size:
+        # Trailing partial header.
+        raise ValueError('truncated inotify event')
+    return events
+
+# Use the C parser when the extension module provides it.
+_parse_events = getattr(inotify_syscalls, 'parse_events', None) or \
+    _parse_events_py
+
+
+# Clock used to measure durations.
+_clock = time.time
+
+# Encoding of file names, it does not change once the interpreter is started.
+_FS_ENCODING = sys.getfilesystemencoding()
+
 
 __author__ = "seb@dbzteam.org (Sebastien Martini)"
 
@@ -202,6 +249,10 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
     def __init__(self):
         self._libc = None
         self._get_errno_func = None
+        self._has_init1 = False
+        # Cached function pointers, see init().
+        self._add_watch_func = None
+        self._rm_watch_func = None
 
     def init(self):
         assert ctypes
@@ -241,6 +292,17 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
         self._libc.inotify_add_watch.restype = ctypes.c_int
         self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
         self._libc.inotify_rm_watch.restype = ctypes.c_int
+        # Saves an attribute lookup on the CDLL object for each call.
+        self._add_watch_func = self._libc.inotify_add_watch
+        self._rm_watch_func = self._libc.inotify_rm_watch
+        # inotify_init1() (Linux >= 2.6.27) directly creates a close-on-exec
+        # file descriptor. IN_CLOEXEC is only known for Linux, where it
+        # is O_CLOEXEC's value (not provided by os before Python 3.3).
+        if (hasattr(self._libc, 'inotify_init1') and
+            sys.platform.startswith('linux')):
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_init1.restype = ctypes.c_int
+            self._has_init1 = True
         return True
 
     def _get_errno(self):
@@ -250,16 +312,29 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
 
     def _inotify_init(self):
         assert self._libc is not None
-        return self._libc.inotify_init()
+        if self._has_init1:
+            # IN_CLOEXEC | IN_NONBLOCK
+            fd = self._libc.inotify_init1(02000000 | os.O_NONBLOCK)
+            if fd != -1 or self._get_errno() not in (errno.ENOSYS,
+                                                     errno.EINVAL):
+                return fd
+            # Provided by libc but not by the running kernel (ENOSYS) or
+            # flags not supported (EINVAL).
+            self._has_init1 = False
+        fd = self._libc.inotify_init()
+        if fd != -1:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return fd
 
     def _inotify_add_watch(self, fd, pathname, mask):
         assert self._libc is not None
-        pathname = ctypes.create_string_buffer(pathname)
-        return self._libc.inotify_add_watch(fd, pathname, mask)
+        # Its argtypes were set in init(), thus ctypes directly passes the
+        # string as a char pointer without requiring an intermediate buffer.
+        return self._add_watch_func(fd, pathname, mask)
 
     def _inotify_rm_watch(self, fd, wd):
         assert self._libc is not None
-        return self._libc.inotify_rm_watch(fd, wd)
+        return self._rm_watch_func(fd, wd)
 
 
 # Logging
@@ -298,7 +373,7 @@ class ProcINotify:
         @rtype: int
         @raise IOError: if corresponding file in /proc/sys cannot be read.
         """
-        file_obj = file(os.path.join(self._base, self._attr), 'r')
+        file_obj = open(os.path.join(self._base, self._attr), 'r')
         try:
             val = int(file_obj.readline())
         finally:
@@ -313,7 +388,7 @@ class ProcINotify:
         @type nval: int
         @raise IOError: if corresponding file in /proc/sys cannot be written.
         """
-        file_obj = file(os.path.join(self._base, self._attr), 'w')
+        file_obj = open(os.path.join(self._base, self._attr), 'w')
         try:
             file_obj.write(str(nval) + '\n')
         finally:
@@ -442,6 +517,9 @@ class EventsCodes:
         @return: event name.
         @rtype: str
         """
+        name = EventsCodes._MASKNAMES.get(mask)
+        if name is not None:
+            return name
         ms = mask
         name = '%s'
         if mask & IN_ISDIR:
@@ -475,6 +553,22 @@ ALL_EVENTS = reduce(lambda x, y: x | y, EventsCodes.OP_FLAGS.values())
 EventsCodes.ALL_FLAGS['ALL_EVENTS'] = ALL_EVENTS
 EventsCodes.ALL_VALUES[ALL_EVENTS] = 'ALL_EVENTS'
 
+# Events raised against the watched item itself.
+_SELF_MASK = IN_DELETE_SELF | IN_MOVE_SELF
+
+# Size of the buffer used to read events when no threshold is set, it is
+# much larger than the biggest event.
+_READ_SIZE = 65536
+# Size of the biggest event: 16 bytes + NAME_MAX + 1.
+_MAX_EVENT_SIZE = 16 + 256
+
+# Precomputed event names, with and without IN_ISDIR, see maskname().
+EventsCodes._MASKNAMES = {}
+for valc, namec in EventsCodes.ALL_VALUES.items():
+    EventsCodes._MASKNAMES[valc] = namec
+    if not valc & IN_ISDIR:
+        EventsCodes._MASKNAMES[valc | IN_ISDIR] = namec + '|IN_ISDIR'
+
 
 class _Event:
     """
@@ -482,6 +576,8 @@ class _Event:
     is the base class and should be subclassed.
 
     """
+    __slots__ = ()
+
     def __init__(self, dict_):
         """
         Attach attributes (contained in dict_) to self.
@@ -497,23 +593,38 @@ class _Event:
         @return: Generic event string representation.
         @rtype: str
         """
-        s = ''
-        for attr, value in sorted(self.__dict__.items(), key=lambda x: x[0]):
+        field_name = output_format.field_name
+        field_value = output_format.field_value
+        punctuation = output_format.punctuation
+        equal = punctuation('=')
+        if hasattr(self, '__dict__'):
+            items = list(self.__dict__.items())
+            if COMPATIBILITY_MODE:
+                # These aliases are properties, see compatibility_mode().
+                for attr in ('event_name', 'is_dir'):
+                    try:
+                        items.append((attr, getattr(self, attr)))
+                    except AttributeError:
+                        pass
+            items.sort()
+        else:
+            items = [(attr, getattr(self, attr))
+                     for attr in sorted(self.__slots__)]
+        fields = []
+        for attr, value in items:
             if attr.startswith('_'):
                 continue
             if attr == 'mask':
-                value = hex(getattr(self, attr))
+                value = hex(value)
             elif isinstance(value, basestring) and not value:
                 value = "''"
-            s += ' %s%s%s' % (output_format.field_name(attr),
-                              output_format.punctuation('='),
-                              output_format.field_value(value))
-
-        s = '%s%s%s %s' % (output_format.punctuation('<'),
-                           output_format.class_name(self.__class__.__name__),
-                           s,
-                           output_format.punctuation('>'))
-        return s
+            fields.append(' %s%s%s' % (field_name(attr), equal,
+                                       field_value(value)))
+
+        return '%s%s%s %s' % (punctuation('<'),
+                              output_format.class_name(self.__class__.__name__),
+                              ''.join(fields),
+                              punctuation('>'))
 
     def __str__(self):
         return repr(self)
@@ -524,6 +635,8 @@ class _RawEvent(_Event):
     Raw event, it contains only the informations provided by the system.
     It doesn't infer anything.
     """
+    __slots__ = ('wd', 'mask', 'cookie', 'name', '_str')
+
     def __init__(self, wd, mask, cookie, name):
         """
         @param wd: Watch Descriptor.
@@ -541,13 +654,13 @@ class _RawEvent(_Event):
         # Use this variable to cache the result of str(self), this object
         # is immutable.
         self._str = None
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
         # name: remove trailing '\0'
-        d = {'wd': wd,
-             'mask': mask,
-             'cookie': cookie,
-             'name': name.rstrip('\0')}
-        _Event.__init__(self, d)
-        log.debug(str(self))
+        self.name = name.rstrip('\0')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(str(self))
 
     def __str__(self):
         if self._str is None:
@@ -585,10 +698,13 @@ class Event(_Event):
         """
         Concretely, this is the raw event plus inferred infos.
         """
-        _Event.__init__(self, raw)
+        # Unlike _RawEvent, Event instances have a __dict__, it is filled
+        # at once instead of through one setattr() call per attribute.
+        self.__dict__.update(raw)
         self.maskname = EventsCodes.maskname(self.mask)
-        if COMPATIBILITY_MODE:
-            self.event_name = self.maskname
+        if 'pathname' in raw:
+            # Already provided (see _SysProcessEvent.process_default).
+            return
         try:
             if self.name:
                 self.pathname = os.path.abspath(os.path.join(self.path,
@@ -617,6 +733,11 @@ class _ProcessEvent:
     """
     Abstract processing event class.
     """
+    # Lazily filled {event mask: bound processing method} memo. Note that
+    # process_* methods bound after the first event of a given mask has
+    # been dispatched are not taken into account for that mask.
+    __methods = None
+
     def __call__(self, event):
         """
         To behave like a functor the object must be callable.
@@ -636,7 +757,39 @@ class _ProcessEvent:
         @raise ProcessEventError: Event object undispatchable,
                                   unknown event.
         """
-        stripped_mask = event.mask - (event.mask & IN_ISDIR)
+        return self._get_method(event.mask)(event)
+
+    def _get_method(self, mask):
+        """
+        Get the processing method associated to mask, it is resolved by
+        _lookup_method() the first time and memoized afterward.
+
+        @param mask: Event mask.
+        @type mask: int
+        @return: Bound processing method.
+        @rtype: callable
+        @raise ProcessEventError: Unknown event.
+        """
+        methods = self.__methods
+        if methods is None:
+            methods = self.__methods = {}
+        meth = methods.get(mask)
+        if meth is None:
+            stripped_mask = mask - (mask & IN_ISDIR)
+            meth = methods[mask] = self._lookup_method(stripped_mask)
+        return meth
+
+    def _lookup_method(self, stripped_mask):
+        """
+        Resolve the processing method associated to stripped_mask, see
+        __call__() for the lookup order.
+
+        @param stripped_mask: Event mask without IN_ISDIR.
+        @type stripped_mask: int
+        @return: Bound processing method.
+        @rtype: callable
+        @raise ProcessEventError: Unknown event.
+        """
         maskname = EventsCodes.ALL_VALUES.get(stripped_mask)
         if maskname is None:
             raise ProcessEventError("Unknown mask 0x%08x" % stripped_mask)
@@ -644,18 +797,38 @@ class _ProcessEvent:
         # 1- look for process_MASKNAME
         meth = getattr(self, 'process_' + maskname, None)
         if meth is not None:
-            return meth(event)
+            return meth
         # 2- look for process_FAMILY_NAME
         meth = getattr(self, 'process_IN_' + maskname.split('_')[1], None)
         if meth is not None:
-            return meth(event)
+            return meth
         # 3- default call method process_default
-        return self.process_default(event)
+        return self.process_default
 
     def __repr__(self):
         return '<%s>' % self.__class__.__name__
 
 
+def _list_dir_types(path):
+    """
+    Yields (name, is_file, is_dir) for each entry of directory path,
+    is_file and is_dir both follow symlinks. When available scandir() is
+    used, it provides the type of most entries without stat() calls.
+
+    @param path: Directory path.
+    @type path: str
+    @raise OSError: If path cannot be listed.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_file(), entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            inner = os.path.join(path, name)
+            is_file = os.path.isfile(inner)
+            yield name, is_file, not is_file and os.path.isdir(inner)
+
+
 class _SysProcessEvent(_ProcessEvent):
     """
     There is three kind of processing according to each event:
@@ -676,22 +849,54 @@ class _SysProcessEvent(_ProcessEvent):
         """
         self._watch_manager = wm  # watch manager
         self._notifier = notifier  # notifier
-        self._mv_cookie = {}  # {cookie(int): (src_path(str), date), ...}
-        self._mv = {}  # {src_path(str): (dst_path(str), date), ...}
+        self._mv_cookie = {}  # {cookie(int): (src_path(str), time), ...}
+        self._mv = {}  # {src_path(str): (dst_path(str), time), ...}
+        # Records of both dicts in insertion (i.e. time) order:
+        # [(time, dict, key), ...]
+        self._mv_records = deque()
+
+    def __call__(self, raw_event, watch_=None):
+        """
+        Same dispatch than _ProcessEvent.__call__() except that the Watch
+        associated to raw_event is passed along to the processing method,
+        the caller usually already has it at hand.
+
+        @param raw_event: Event to be processed.
+        @type raw_event: _RawEvent instance
+        @param watch_: Watch of raw_event.wd, looked up if not provided.
+        @type watch_: Watch instance
+        @return: Processed event.
+        @rtype: Event instance
+        """
+        if watch_ is None:
+            watch_ = self._watch_manager.get_watch(raw_event.wd)
+        return self._get_method(raw_event.mask)(raw_event, watch_)
 
     def cleanup(self):
         """
         Cleanup (delete) old (>1mn) records contained in self._mv_cookie
         and self._mv.
         """
-        date_cur_ = datetime.now()
-        for seq in [self._mv_cookie, self._mv]:
-            for k in seq.keys():
-                if (date_cur_ - seq[k][1]) > timedelta(minutes=1):
-                    log.debug('Cleanup: deleting entry %s', seq[k][0])
-                    del seq[k]
+        oldest = _clock() - 60  # 1mn
+        records = self._mv_records
+        while records and records[0][0] < oldest:
+            date, seq, key = records.popleft()
+            entry = seq.get(key)
+            # Skip records overwritten since then.
+            if entry is not None and entry[1] == date:
+                log.debug('Cleanup: deleting entry %s', entry[0])
+                del seq[key]
+
+    def __add_mv_record(self, seq, key, path):
+        """
+        Map key to path (+ date for cleaning) in seq, one of self._mv_cookie
+        or self._mv.
+        """
+        date = _clock()
+        seq[key] = (path, date)
+        self._mv_records.append((date, seq, key))
 
-    def process_IN_CREATE(self, raw_event):
+    def process_IN_CREATE(self, raw_event, watch_):
         """
         If the event affects a directory and the auto_add flag of the
         targetted watch is set to True, a new watch is added on this
@@ -699,7 +904,6 @@ class _SysProcessEvent(_ProcessEvent):
         this watch.
         """
         if raw_event.mask & IN_ISDIR:
-            watch_ = self._watch_manager.get_watch(raw_event.wd)
             created_dir = os.path.join(watch_.path, raw_event.name)
             if watch_.auto_add and not watch_.exclude_filter(created_dir):
                 addw = self._watch_manager.add_watch
@@ -718,16 +922,17 @@ class _SysProcessEvent(_ProcessEvent):
                 if ((created_dir_wd is not None) and (created_dir_wd > 0) and
                     os.path.isdir(created_dir)):
                     try:
-                        for name in os.listdir(created_dir):
+                        for name, is_file, is_dir in \
+                                _list_dir_types(created_dir):
                             inner = os.path.join(created_dir, name)
                             if self._watch_manager.get_wd(inner) is not None:
                                 continue
                             # Generate (simulate) creation events for sub-
                             # directories and files.
-                            if os.path.isfile(inner):
+                            if is_file:
                                 # symlinks are handled as files.
                                 flags = IN_CREATE
-                            elif os.path.isdir(inner):
+                            elif is_dir:
                                 flags = IN_CREATE | IN_ISDIR
                             else:
                                 # This path should not be taken.
@@ -736,37 +941,41 @@ class _SysProcessEvent(_ProcessEvent):
                             self._notifier.append_event(rawevent)
                     except OSError, err:
                         msg = "process_IN_CREATE, invalid directory %s: %s"
-                        log.debug(msg % (created_dir, str(err)))
-        return self.process_default(raw_event)
+                        log.debug(msg, created_dir, err)
+        return self.process_default(raw_event, watch_)
 
-    def process_IN_MOVED_FROM(self, raw_event):
+    def process_IN_MOVED_FROM(self, raw_event, watch_):
         """
         Map the cookie with the source path (+ date for cleaning).
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         path_ = watch_.path
-        src_path = os.path.normpath(os.path.join(path_, raw_event.name))
-        self._mv_cookie[raw_event.cookie] = (src_path, datetime.now())
-        return self.process_default(raw_event, {'cookie': raw_event.cookie})
+        # Watch paths are normalized and the name is a single component,
+        # thus the joined path is already normalized.
+        src_path = os.path.join(path_, raw_event.name)
+        self.__add_mv_record(self._mv_cookie, raw_event.cookie, src_path)
+        event_ = self.process_default(raw_event, watch_)
+        event_.cookie = raw_event.cookie
+        return event_
 
-    def process_IN_MOVED_TO(self, raw_event):
+    def process_IN_MOVED_TO(self, raw_event, watch_):
         """
         Map the source path with the destination path (+ date for
         cleaning).
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         path_ = watch_.path
-        dst_path = os.path.normpath(os.path.join(path_, raw_event.name))
+        # Watch paths are normalized and the name is a single component,
+        # thus the joined path is already normalized.
+        dst_path = os.path.join(path_, raw_event.name)
         mv_ = self._mv_cookie.get(raw_event.cookie)
-        to_append = {'cookie': raw_event.cookie}
+        src_pathname = None
         if mv_ is not None:
-            self._mv[mv_[0]] = (dst_path, datetime.now())
+            self.__add_mv_record(self._mv, mv_[0], dst_path)
             # Let's assume that IN_MOVED_FROM event is always queued before
             # that its associated (they share a common cookie) IN_MOVED_TO
             # event is queued itself. It is then possible in that scenario
             # to provide as additional information to the IN_MOVED_TO event
             # the original pathname of the moved file/directory.
-            to_append['src_pathname'] = mv_[0]
+            src_pathname = mv_[0]
         elif (raw_event.mask & IN_ISDIR and watch_.auto_add and
               not watch_.exclude_filter(dst_path)):
             # We got a diretory that's "moved in" from an unknown source and
@@ -777,9 +986,13 @@ class _SysProcessEvent(_ProcessEvent):
                                           proc_fun=watch_.proc_fun,
                                           rec=True, auto_add=True,
                                           exclude_filter=watch_.exclude_filter)
-        return self.process_default(raw_event, to_append)
+        event_ = self.process_default(raw_event, watch_)
+        event_.cookie = raw_event.cookie
+        if src_pathname is not None:
+            event_.src_pathname = src_pathname
+        return event_
 
-    def process_IN_MOVE_SELF(self, raw_event):
+    def process_IN_MOVE_SELF(self, raw_event, watch_):
         """
         STATUS: the following bug has been fixed in recent kernels (FIXME:
         which version ?). Now it raises IN_DELETE_SELF instead.
@@ -791,23 +1004,14 @@ class _SysProcessEvent(_ProcessEvent):
         doesn't bring us enough informations like the destination path of
         moved items.
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         src_path = watch_.path
         mv_ = self._mv.get(src_path)
         if mv_:
-            dest_path = mv_[0]
-            watch_.path = dest_path
-            # add the separator to the source path to avoid overlapping
-            # path issue when testing with startswith()
-            src_path += os.path.sep
-            src_path_len = len(src_path)
-            # The next loop renames all watches with src_path as base path.
+            # Renames watch_ and all watches with src_path as base path.
             # It seems that IN_MOVE_SELF does not provide IN_ISDIR information
-            # therefore the next loop is iterated even if raw_event is a file.
-            for w in self._watch_manager.watches.values():
-                if w.path.startswith(src_path):
-                    # Note that dest_path is a normalized path.
-                    w.path = os.path.join(dest_path, w.path[src_path_len:])
+            # therefore the sub watches are looked up even if raw_event is a
+            # file.
+            self._watch_manager._move_watch_tree(watch_, mv_[0])
         else:
             log.error("The pathname '%s' of this watch %s has probably changed "
                       "and couldn't be updated, so it cannot be trusted "
@@ -818,49 +1022,53 @@ class _SysProcessEvent(_ProcessEvent):
                       os.path.normpath(os.path.join(watch_.path,
                                                     os.path.pardir)))
             if not watch_.path.endswith('-unknown-path'):
-                watch_.path += '-unknown-path'
-        return self.process_default(raw_event)
+                self._watch_manager._set_watch_path(watch_,
+                                                    watch_.path +
+                                                    '-unknown-path')
+        return self.process_default(raw_event, watch_)
 
-    def process_IN_Q_OVERFLOW(self, raw_event):
+    def process_IN_Q_OVERFLOW(self, raw_event, watch_):
         """
         Only signal an overflow, most of the common flags are irrelevant
         for this event (path, wd, name).
         """
         return Event({'mask': raw_event.mask})
 
-    def process_IN_IGNORED(self, raw_event):
+    def process_IN_IGNORED(self, raw_event, watch_):
         """
         The watch descriptor raised by this event is now ignored (forever),
         it can be safely deleted from the watch manager dictionary.
         After this event we can be sure that neither the event queue nor
         the system will raise an event associated to this wd again.
         """
-        event_ = self.process_default(raw_event)
+        event_ = self.process_default(raw_event, watch_)
         self._watch_manager.del_watch(raw_event.wd)
         return event_
 
-    def process_default(self, raw_event, to_append=None):
+    def process_default(self, raw_event, watch_):
         """
         Commons handling for the followings events:
 
         IN_ACCESS, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_CLOSE_NOWRITE,
         IN_OPEN, IN_DELETE, IN_DELETE_SELF, IN_UNMOUNT.
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
-        if raw_event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        mask = raw_event.mask
+        if mask & _SELF_MASK:
             # Unfornulately this information is not provided by the kernel
             dir_ = watch_.dir
         else:
-            dir_ = bool(raw_event.mask & IN_ISDIR)
+            dir_ = bool(mask & IN_ISDIR)
+        # The name given by the kernel is a single path component, joining
+        # it to the normalized watch path is enough.
+        pathname = watch_._get_abspath()
+        if raw_event.name:
+            pathname = os.path.join(pathname, raw_event.name)
         dict_ = {'wd': raw_event.wd,
-                 'mask': raw_event.mask,
+                 'mask': mask,
                  'path': watch_.path,
                  'name': raw_event.name,
+                 'pathname': pathname,
                  'dir': dir_}
-        if COMPATIBILITY_MODE:
-            dict_['is_dir'] = dir_
-        if to_append is not None:
-            dict_.update(to_append)
         return Event(dict_)
 
 
@@ -1000,6 +1208,10 @@ class ChainIfTrue(ProcessEvent):
         return not self._func(event)
 
 
+# {mask: tuple of the event names in its maskname}, shared by Stats instances.
+_maskname_parts = {}
+
+
 class Stats(ProcessEvent):
     """
     Compute and display trivial statistics about processed events.
@@ -1008,17 +1220,22 @@ class Stats(ProcessEvent):
         """
         Method automatically called from base class constructor.
         """
-        self._start_time = time.time()
+        self._start_time = _clock()
         self._stats = {}
         self._stats_lock = threading.Lock()
+        # (key, string) of the last histogram rendered by __str__
+        self._str_cache = (None, '')
 
     def process_default(self, event):
         """
         Processes |event|.
         """
+        events = _maskname_parts.get(event.mask)
+        if events is None:
+            events = tuple(event.maskname.split('|'))
+            _maskname_parts[event.mask] = events
         self._stats_lock.acquire()
         try:
-            events = event.maskname.split('|')
             for event_name in events:
                 count = self._stats.get(event_name, 0)
                 self._stats[event_name] = count + 1
@@ -1035,7 +1252,7 @@ class Stats(ProcessEvent):
     def __repr__(self):
         stats = self._stats_copy()
 
-        elapsed = int(time.time() - self._start_time)
+        elapsed = int(_clock() - self._start_time)
         elapsed_str = ''
         if elapsed < 60:
             elapsed_str = str(elapsed) + 'sec'
@@ -1048,7 +1265,7 @@ class Stats(ProcessEvent):
         stats['ElapsedTime'] = elapsed_str
 
         l = []
-        for ev, value in sorted(stats.items(), key=lambda x: x[0]):
+        for ev, value in sorted(stats.items()):
             l.append(' %s=%s' % (output_format.field_name(ev),
                                  output_format.field_value(value)))
         s = '<%s%s >' % (output_format.class_name(self.__class__.__name__),
@@ -1073,15 +1290,25 @@ class Stats(ProcessEvent):
         if not stats:
             return ''
 
+        items = sorted(stats.items())
+        # Rendering only depends on the counters, the scale and the current
+        # output format, reuse the previous string if none of them changed.
+        key = (tuple(items), scale, output_format)
+        if self._str_cache[0] == key:
+            return self._str_cache[1]
+
         m = max(stats.values())
         unity = float(scale) / m
         fmt = '%%-26s%%-%ds%%s' % (len(output_format.field_value('@' * scale))
                                    + 1)
-        def func(x):
-            return fmt % (output_format.field_name(x[0]),
-                          output_format.field_value('@' * int(x[1] * unity)),
-                          output_format.simple('%d' % x[1], 'yellow'))
-        s = '\n'.join(map(func, sorted(stats.items(), key=lambda x: x[0])))
+        field_name = output_format.field_name
+        field_value = output_format.field_value
+        simple = output_format.simple
+        s = '\n'.join([fmt % (field_name(name),
+                              field_value('@' * int(count * unity)),
+                              simple('%d' % count, 'yellow'))
+                       for name, count in items])
+        self._str_cache = (key, s)
         return s
 
 
@@ -1104,7 +1331,7 @@ class Notifier:
 
     """
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None):
+                 threshold=0, timeout=None, eventq_maxlen=None):
         """
         Initialization. read_freq, threshold and timeout parameters are used
         when looping.
@@ -1132,6 +1359,14 @@ class Notifier:
                         milliseconds. See
                         https://docs.python.org/2/library/select.html#polling-objects
         @type timeout: int
+        @param eventq_maxlen: Maximum number of events held in the internal
+                              queue between their reading and their
+                              processing. If None (default) the queue is
+                              unbounded. Otherwise when the queue is full the
+                              oldest events are dropped and accounted in
+                              dropped_events. Requires Python >= 2.6.
+        @type eventq_maxlen: int
+        @raise NotifierError: If eventq_maxlen is given on Python < 2.6.
         """
         # Watch Manager instance
         self._watch_manager = watch_manager
@@ -1142,8 +1377,16 @@ class Notifier:
         self._pollobj.register(self._fd, select.POLLIN)
         # This pipe is correctely initialized and used by ThreadedNotifier
         self._pipe = (-1, -1)
-        # Event queue
-        self._eventq = deque()
+        # Event queue, optionally bounded
+        if eventq_maxlen is None:
+            self._eventq = deque()
+        elif sys.version_info < (2, 6):
+            # deque's maxlen is not available before Python 2.6.
+            raise NotifierError('eventq_maxlen requires Python >= 2.6')
+        else:
+            self._eventq = deque(maxlen=eventq_maxlen)
+        # Number of events dropped from the bounded event queue
+        self._dropped = 0
         # System processing functor, common to all events
         self._sys_proc_fun = _SysProcessEvent(self._watch_manager, self)
         # Default processing method
@@ -1166,7 +1409,25 @@ class Notifier:
         @param event: An event.
         @type event: _RawEvent instance.
         """
+        before = len(self._eventq)
         self._eventq.append(event)
+        if len(self._eventq) == before:
+            self._account_dropped(1)
+
+    def _account_dropped(self, count):
+        self._dropped += count
+        log.warning('Event queue full, %d event(s) dropped.', count)
+
+    @property
+    def dropped_events(self):
+        """
+        Number of events dropped so far because the bounded event queue
+        was full (see eventq_maxlen).
+
+        @return: Count of dropped events.
+        @rtype: int
+        """
+        return self._dropped
 
     def proc_fun(self):
         return self._default_proc_fun
@@ -1225,43 +1486,74 @@ class Notifier:
     def read_events(self):
         """
         Read events from device, build _RawEvents, and enqueue them.
+
+        @return: True if events were read and the read buffer could not
+                 hold another event, in which case more events are likely
+                 pending (burst), False otherwise.
+        @rtype: bool
         """
-        buf_ = array.array('i', [0])
-        # get event queue size
-        if fcntl.ioctl(self._fd, termios.FIONREAD, buf_, 1) == -1:
-            return
-        queue_size = buf_[0]
-        if queue_size < self._threshold:
-            log.debug('(fd: %d) %d bytes available to read but threshold is '
-                      'fixed to %d bytes', self._fd, queue_size,
-                      self._threshold)
-            return
+        if self._threshold:
+            buf_ = array.array('i', [0])
+            # get event queue size
+            if fcntl.ioctl(self._fd, termios.FIONREAD, buf_, 1) == -1:
+                return False
+            queue_size = buf_[0]
+            if queue_size < self._threshold:
+                log.debug('(fd: %d) %d bytes available to read but threshold '
+                          'is fixed to %d bytes', self._fd, queue_size,
+                          self._threshold)
+                return False
+            if not queue_size:
+                return False
+        else:
+            # No need to query the event queue size, the file descriptor
+            # is non-blocking (see WatchManager.get_fd()), reading an empty
+            # queue fails with EAGAIN.
+            queue_size = _READ_SIZE
 
         try:
             # Read content from file
             r = os.read(self._fd, queue_size)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return False
+            raise NotifierError(err)
         except Exception, msg:
             raise NotifierError(msg)
-        log.debug('Event queue size: %d', queue_size)
-        rsum = 0  # counter
-        while rsum < queue_size:
-            s_size = 16
-            # Retrieve wd, mask, cookie and fname_len
-            wd, mask, cookie, fname_len = struct.unpack('iIII',
-                                                        r[rsum:rsum+s_size])
-            # Retrieve name
-            fname, = struct.unpack('%ds' % fname_len,
-                                   r[rsum + s_size:rsum + s_size + fname_len])
-            rawevent = _RawEvent(wd, mask, cookie, fname)
-            if self._coalesce:
-                # Only enqueue new (unique) events.
-                raweventstr = str(rawevent)
-                if raweventstr not in self._eventset:
-                    self._eventset.add(raweventstr)
-                    self._eventq.append(rawevent)
-            else:
-                self._eventq.append(rawevent)
-            rsum += s_size + fname_len
+        if not r:
+            return False
+        log.debug('Event queue size: %d', len(r))
+        try:
+            events = _parse_events(r)
+        except ValueError, err:
+            # Same error from the C and the Python parsers.
+            raise NotifierError(err)
+        eventq = self._eventq
+        before = len(eventq)
+        if self._coalesce:
+            eventset = self._eventset
+            batch = []
+            for event in events:
+                # Only enqueue new (unique) events, the parsed
+                # (wd, mask, cookie, name) tuple identifies them.
+                if event not in eventset:
+                    eventset.add(event)
+                    wd, mask, cookie, fname = event
+                    batch.append(_RawEvent(wd, mask, cookie, fname))
+        else:
+            batch = [_RawEvent(wd, mask, cookie, fname)
+                     for wd, mask, cookie, fname in events]
+        eventq.extend(batch)
+        pushed = len(batch)
+        dropped = before + pushed - len(eventq)
+        if dropped > 0:
+            self._account_dropped(dropped)
+        # With a threshold the whole queue was read at once. Otherwise
+        # re-reading is only worth it if the buffer was full, returning True
+        # after any read would skip check_events() (and its timeout) as long
+        # as events trickle in.
+        return (not self._threshold and
+                _READ_SIZE - len(r) < _MAX_EVENT_SIZE)
 
     def process_events(self):
         """
@@ -1269,12 +1561,24 @@ class Notifier:
         associated proccessing method (an instance of ProcessEvent).
         It also does internal processings, to keep the system updated.
         """
-        while self._eventq:
-            raw_event = self._eventq.popleft()  # pop next event
-            if self._watch_manager.ignore_events:
-                log.debug("Event ignored: %s" % repr(raw_event))
+        eventq = self._eventq
+        watch_manager = self._watch_manager
+        get_watch = watch_manager.get_watch
+        sys_proc_fun = self._sys_proc_fun
+        default_proc_fun = self._default_proc_fun
+        if watch_manager.ignore_events:
+            # Drop the whole batch at once.
+            if log.isEnabledFor(logging.DEBUG):
+                for raw_event in eventq:
+                    log.debug("Event ignored: %r", raw_event)
+            eventq.clear()
+        while eventq:
+            raw_event = eventq.popleft()  # pop next event
+            if watch_manager.ignore_events:
+                # Set from a processing function.
+                log.debug("Event ignored: %r", raw_event)
                 continue
-            watch_ = self._watch_manager.get_watch(raw_event.wd)
+            watch_ = get_watch(raw_event.wd)
             if (watch_ is None) and not (raw_event.mask & IN_Q_OVERFLOW):
                 if not (raw_event.mask & IN_IGNORED):
                     # Not really sure how we ended up here, nor how we should
@@ -1283,12 +1587,12 @@ class Notifier:
                     log.warning("Unable to retrieve Watch object associated to %s",
                                 repr(raw_event))
                 continue
-            revent = self._sys_proc_fun(raw_event)  # system processings
-            if watch_ and watch_.proc_fun:
-                watch_.proc_fun(revent)  # user processings
-            else:
-                self._default_proc_fun(revent)
-        self._sys_proc_fun.cleanup()  # remove olds MOVED_* events records
+            revent = sys_proc_fun(raw_event, watch_)  # system processings
+            # user processings, the watch's own processing function if it has
+            # one, the default one otherwise
+            proc_fun = watch_ and watch_.proc_fun or default_proc_fun
+            proc_fun(revent)
+        sys_proc_fun.cleanup()  # remove olds MOVED_* events records
         if self._coalesce:
             self._eventset.clear()
 
@@ -1331,12 +1635,15 @@ class Notifier:
                 # parent 1
                 os._exit(0)
 
-            fd_inp = os.open(stdin, os.O_RDONLY)
-            os.dup2(fd_inp, 0)
-            fd_out = os.open(stdout, os.O_WRONLY|os.O_CREAT, 0600)
-            os.dup2(fd_out, 1)
-            fd_err = os.open(stderr, os.O_WRONLY|os.O_CREAT, 0600)
-            os.dup2(fd_err, 2)
+            # Append to existing files rather than overwriting them in place.
+            flags = os.O_WRONLY|os.O_CREAT|os.O_APPEND
+            for path, oflags, std_fd in ((stdin, os.O_RDONLY, 0),
+                                         (stdout, flags, 1),
+                                         (stderr, flags, 2)):
+                fd = os.open(path, oflags, 0600)
+                if fd != std_fd:
+                    os.dup2(fd, std_fd)
+                    os.close(fd)
 
         # Detach task
         fork_daemon()
@@ -1348,12 +1655,12 @@ class Notifier:
             os.write(fd_pid, str(os.getpid()) + '\n')
             os.close(fd_pid)
             # Register unlink function
-            atexit.register(lambda : os.unlink(pid_file))
+            atexit.register(os.unlink, pid_file)
 
     def _sleep(self, ref_time):
         # Only consider sleeping if read_freq is > 0
         if self._read_freq > 0:
-            cur_time = time.time()
+            cur_time = _clock()
             sleep_amount = self._read_freq - (cur_time - ref_time)
             if sleep_amount > 0:
                 log.debug('Now sleeping %d seconds', sleep_amount)
@@ -1388,16 +1695,27 @@ class Notifier:
             self.__daemonize(**args)
 
         # Read and process events forever
+        process_events = self.process_events
+        check_events = self.check_events
+        read_events = self.read_events
+        sleep = self._sleep
+        more = False
         while 1:
             try:
-                self.process_events()
+                process_events()
                 if (callback is not None) and (callback(self) is True):
                     break
-                ref_time = time.time()
-                # check_events is blocking
-                if self.check_events():
-                    self._sleep(ref_time)
-                    self.read_events()
+                ref_time = _clock()
+                # check_events is blocking, it is skipped after a read that
+                # filled the buffer because under a burst more events are
+                # likely pending, read_events returns False without reading
+                # if there are not. Nor is read_freq slept again before these
+                # re-reads.
+                if more:
+                    more = read_events()
+                elif check_events():
+                    sleep(ref_time)
+                    more = read_events()
             except KeyboardInterrupt:
                 # Stop monitoring if sigint is caught (Control-C).
                 log.debug('Pyinotify stops monitoring.')
@@ -1429,7 +1747,7 @@ class ThreadedNotifier(threading.Thread, Notifier):
     it is not threaded and could be easily daemonized.
     """
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None):
+                 threshold=0, timeout=None, eventq_maxlen=None):
         """
         Initialization, initialize base classes. read_freq, threshold and
         timeout parameters are used when looping.
@@ -1454,6 +1772,8 @@ class ThreadedNotifier(threading.Thread, Notifier):
                         milliseconds. See
                         https://docs.python.org/2/library/select.html#select.poll.poll
         @type timeout: int
+        @param eventq_maxlen: Optional event queue bound. See base class.
+        @type eventq_maxlen: int
         """
         # Init threading base class
         threading.Thread.__init__(self)
@@ -1461,7 +1781,7 @@ class ThreadedNotifier(threading.Thread, Notifier):
         self._stop_event = threading.Event()
         # Init Notifier base class
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         # Create a new pipe used for thread termination
         self._pipe = os.pipe()
         self._pollobj.register(self._pipe[0], select.POLLIN)
@@ -1490,12 +1810,21 @@ class ThreadedNotifier(threading.Thread, Notifier):
         # is written to pipe fd so poll() returns and .check_events()
         # returns False which make evaluate the While's stop condition
         # ._stop_event.isSet() wich put an end to the thread's execution.
-        while not self._stop_event.isSet():
-            self.process_events()
-            ref_time = time.time()
-            if self.check_events():
-                self._sleep(ref_time)
-                self.read_events()
+        stop_is_set = self._stop_event.isSet
+        process_events = self.process_events
+        check_events = self.check_events
+        read_events = self.read_events
+        sleep = self._sleep
+        more = False
+        while not stop_is_set():
+            process_events()
+            ref_time = _clock()
+            # See Notifier.loop() about skipping check_events() and sleep().
+            if more:
+                more = read_events()
+            elif check_events():
+                sleep(ref_time)
+                more = read_events()
 
     def run(self):
         """
@@ -1515,7 +1844,8 @@ class AsyncNotifier(asyncore.file_dispatcher, Notifier):
 
     """
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None, channel_map=None):
+                 threshold=0, timeout=None, channel_map=None,
+                 eventq_maxlen=None):
         """
         Initializes the async notifier. The only additional parameter is
         'channel_map' which is the optional asyncore private map. See
@@ -1523,7 +1853,7 @@ class AsyncNotifier(asyncore.file_dispatcher, Notifier):
 
         """
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         asyncore.file_dispatcher.__init__(self, self._fd, channel_map)
 
     def handle_read(self):
@@ -1544,7 +1874,7 @@ class TornadoAsyncNotifier(Notifier):
     """
     def __init__(self, watch_manager, ioloop, callback=None,
                  default_proc_fun=None, read_freq=0, threshold=0, timeout=None,
-                 channel_map=None):
+                 channel_map=None, eventq_maxlen=None):
         """
         Note that if later you must call ioloop.close() be sure to let the
         default parameter to all_fds=False.
@@ -1561,7 +1891,7 @@ class TornadoAsyncNotifier(Notifier):
         self.io_loop = ioloop
         self.handle_read_callback = callback
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         ioloop.add_handler(self._fd, self.handle_read, ioloop.READ)
 
     def stop(self):
@@ -1586,7 +1916,8 @@ class AsyncioNotifier(Notifier):
 
     """
     def __init__(self, watch_manager, loop, callback=None,
-                 default_proc_fun=None, read_freq=0, threshold=0, timeout=None):
+                 default_proc_fun=None, read_freq=0, threshold=0, timeout=None,
+                 eventq_maxlen=None):
         """
 
         See examples/asyncio_notifier.py for an example usage.
@@ -1602,7 +1933,7 @@ class AsyncioNotifier(Notifier):
         self.loop = loop
         self.handle_read_callback = callback
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         loop.add_reader(self._fd, self.handle_read)
 
     def stop(self):
@@ -1622,7 +1953,7 @@ class Watch:
 
     """
     __slots__ = ('wd', 'path', 'mask', 'proc_fun', 'auto_add',
-                 'exclude_filter', 'dir')
+                 'exclude_filter', 'dir', '_abspath')
 
     def __init__(self, wd, path, mask, proc_fun, auto_add, exclude_filter):
         """
@@ -1630,7 +1961,9 @@ class Watch:
 
         @param wd: Watch descriptor.
         @type wd: int
-        @param path: Path of the file or directory being watched.
+        @param path: Path of the file or directory being watched. Once
+                     the watch is added it may only be changed by the
+                     WatchManager, see WatchManager.get_wd().
         @type path: str
         @param mask: Mask.
         @type mask: int
@@ -1650,12 +1983,31 @@ class Watch:
         self.auto_add = auto_add
         self.exclude_filter = exclude_filter
         self.dir = os.path.isdir(self.path)
+        # (path, absolute path) pair, see _get_abspath().
+        self._abspath = (path, os.path.abspath(path))
+
+    def _get_abspath(self):
+        """
+        @return: Absolute path of the watched item. It is only recomputed
+                 when path is modified (e.g. the watched item was moved).
+        @rtype: str
+        """
+        path = self.path
+        if self._abspath[0] != path:
+            self._abspath = (path, os.path.abspath(path))
+        return self._abspath[1]
 
     def __repr__(self):
         """
         @return: String representation.
         @rtype: str
         """
+        if not output_format.format:
+            # Fast path, no formatting codes to insert.
+            return '<%s %s >' % (self.__class__.__name__,
+                                 ' '.join(['%s=%s' % (attr, getattr(self, attr))
+                                           for attr in self.__slots__
+                                           if not attr.startswith('_')]))
         s = ' '.join(['%s%s%s' % (output_format.field_name(attr),
                                   output_format.punctuation('='),
                                   output_format.field_value(getattr(self,
@@ -1701,9 +2053,30 @@ class ExcludeFilter:
         for regex in lst:
             self._lregex.append(re.compile(regex, re.UNICODE))
 
+        # Try to match all the patterns in a single pass with one
+        # alternation. Patterns with groups (backreferences would be
+        # renumbered) or with differing inline flags are kept apart.
+        self._regex = None
+        if len(self._lregex) > 1:
+            flags = self._lregex[0].flags
+            for regex in self._lregex:
+                if regex.groups or regex.flags != flags:
+                    break
+            else:
+                try:
+                    self._regex = re.compile('|'.join(['(?:%s)' % regex
+                                                       for regex in lst]),
+                                             re.UNICODE)
+                except re.error:
+                    pass
+
+        # Results of __call__(), recursive walks and newly created
+        # directories may lead to test the same paths several times.
+        self._cache = {}  # {path: bool}
+
     def _load_patterns_from_file(self, filename):
         lst = []
-        file_obj = file(filename, 'r')
+        file_obj = open(filename, 'r')
         try:
             for line in file_obj.readlines():
                 # Trim leading an trailing whitespaces
@@ -1726,10 +2099,25 @@ class ExcludeFilter:
                  be excluded, False otherwise.
         @rtype: bool
         """
-        for regex in self._lregex:
-            if self._match(regex, path):
-                return True
-        return False
+        if not self._lregex:
+            return False
+        cache = self._cache
+        ret = cache.get(path)
+        if ret is not None:
+            return ret
+        if self._regex is not None:
+            ret = self._match(self._regex, path)
+        else:
+            ret = False
+            for regex in self._lregex:
+                if self._match(regex, path):
+                    ret = True
+                    break
+        # Bounded, simply start over when full.
+        if len(cache) >= 8192:
+            cache.clear()
+        cache[path] = ret
+        return ret
 
 
 class WatchManagerError(Exception):
@@ -1773,6 +2161,13 @@ class WatchManager:
         self._ignore_events = False
         self._exclude_filter = exclude_filter
         self._wmd = {}  # watch dict key: watch descriptor, value: watch
+        # Watches sorted by path: [(path, wd), ...], the watches located
+        # under a given directory are thus contiguous. Entries are not
+        # removed one by one, they become stale when their path no longer
+        # matches the path of the watch of their wd and are dropped all at
+        # once when they make up half of the index.
+        self._paths = []
+        self._stale = 0  # Number of stale entries
 
         self._inotify_wrapper = INotifyWrapper.create()
         if self._inotify_wrapper is None:
@@ -1782,6 +2177,11 @@ class WatchManager:
         if self._fd < 0:
             err = 'Cannot initialize new instance of inotify, %s'
             raise OSError(err % self._inotify_wrapper.str_errno())
+        # Non-blocking file descriptor, if not already created as such
+        # with IN_NONBLOCK.
+        flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+        if not flags & os.O_NONBLOCK:
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
     def close(self):
         """
@@ -1797,7 +2197,9 @@ class WatchManager:
 
     def get_fd(self):
         """
-        Return assigned inotify's file descriptor.
+        Return assigned inotify's file descriptor. It is in non-blocking
+        mode, reading it when no event is pending fails with EAGAIN instead
+        of blocking, wait for it to be readable first (e.g. with poll).
 
         @return: File descriptor.
         @rtype: int
@@ -1821,7 +2223,8 @@ class WatchManager:
         @type wd: int
         """
         try:
-            del self._wmd[wd]
+            self._wmd.pop(wd)
+            self.__unindex_watch()
         except KeyError, err:
             log.error('Cannot delete unknown watch descriptor %s' % str(err))
 
@@ -1835,6 +2238,128 @@ class WatchManager:
         """
         return self._wmd
 
+    def __is_indexed(self, key):
+        paths = self._paths
+        i = bisect.bisect_left(paths, key)
+        return i < len(paths) and paths[i] == key
+
+    def __index_watch(self, watch_):
+        key = (watch_.path, watch_.wd)
+        if not self.__is_indexed(key):
+            bisect.insort(self._paths, key)
+
+    def __index_watches(self, keys):
+        """
+        Insert several (path, wd) entries at once in the path index.
+        """
+        keys = [key for key in keys if not self.__is_indexed(key)]
+        if len(keys) > 1:
+            self._paths.extend(keys)
+            self._paths.sort()
+        elif keys:
+            bisect.insort(self._paths, keys[0])
+
+    def __unindex_watch(self):
+        """
+        Account for an entry of the path index that became stale, to be
+        called once a watch was removed from the watch manager dictionary
+        or its path changed.
+        """
+        self._stale += 1
+        if self._stale > len(self._paths) // 2:
+            wmd = self._wmd
+            live = []
+            for path, wd in self._paths:
+                watch_ = wmd.get(wd)
+                if watch_ is not None and watch_.path == path:
+                    live.append((path, wd))
+            self._paths[:] = live
+            self._stale = 0
+
+    def _set_watch_path(self, watch_, path):
+        """
+        Update the path of watch_, its path must not be modified directly
+        otherwise it would not be kept in sync in the path index.
+
+        @param watch_: Watch to update.
+        @type watch_: Watch instance
+        @param path: New path.
+        @type path: str
+        """
+        watch_.path = path
+        self.__unindex_watch()
+        self.__index_watch(watch_)
+
+    def _move_watch_tree(self, watch_, path):
+        """
+        Update the path of watch_ and rebase the paths of the watches
+        located under its previous path. The entries of these watches are
+        contiguous in the path index and keep their relative order once
+        rebased, they are thus moved at once instead of one by one.
+
+        @param watch_: Watch of the moved directory.
+        @type watch_: Watch instance
+        @param path: New normalized path.
+        @type path: str
+        """
+        src_prefix = watch_.path
+        if not src_prefix.endswith(os.sep):
+            src_prefix += os.sep
+        dest_prefix = path
+        if not dest_prefix.endswith(os.sep):
+            dest_prefix += os.sep
+        self._set_watch_path(watch_, path)
+
+        paths = self._paths
+        i = j = bisect.bisect_left(paths, (src_prefix,))
+        while j < len(paths) and paths[j][0].startswith(src_prefix):
+            j += 1
+        src_len = len(src_prefix)
+        moved = []
+        for path_, wd in paths[i:j]:
+            w = self._wmd.get(wd)
+            if w is not None and w.path == path_:
+                w.path = dest_prefix + path_[src_len:]
+                moved.append((w.path, wd))
+        del paths[i:j]
+        # Stale entries of the subtree were dropped along the way.
+        self._stale = max(0, self._stale - (j - i - len(moved)))
+        if not moved:
+            return
+        k = bisect.bisect_left(paths, moved[0])
+        if k == len(paths) or moved[-1] < paths[k]:
+            paths[k:k] = moved
+        else:
+            # Some watches were already located under the new path.
+            paths.extend(moved)
+            paths.sort()
+
+    def _get_sub_watches(self, path):
+        """
+        Get the watches whose paths are located under path (path excluded),
+        the cost depends on their number, not on the total number of
+        watches.
+
+        @param path: Normalized directory path.
+        @type path: str
+        @return: List of watches.
+        @rtype: list of Watch instances
+        """
+        # The separator is appended to path to avoid overlapping paths
+        # issues when testing with startswith().
+        prefix = path
+        if not prefix.endswith(os.sep):
+            prefix += os.sep
+        paths = self._paths
+        ret = []
+        i = bisect.bisect_left(paths, (prefix,))
+        while i < len(paths) and paths[i][0].startswith(prefix):
+            watch_ = self._wmd.get(paths[i][1])
+            if watch_ is not None and watch_.path == paths[i][0]:
+                ret.append(watch_)
+            i += 1
+        return ret
+
     def __format_path(self, path):
         """
         Format path to its internal (stored in watch manager) representation.
@@ -1845,24 +2370,33 @@ class WatchManager:
         # Therefore even wd are indexed with bytes string and not with
         # unicode paths.
         if isinstance(path, unicode):
-            path = path.encode(sys.getfilesystemencoding())
+            path = path.encode(_FS_ENCODING)
         return os.path.normpath(path)
 
-    def __add_watch(self, path, mask, proc_fun, auto_add, exclude_filter):
+    def __add_watch(self, path, mask, proc_fun, auto_add, exclude_filter,
+                    pending=None):
         """
         Add a watch on path, build a Watch object and insert it in the
-        watch manager dictionary. Return the wd value.
+        watch manager dictionary. Return the wd value. If pending is a list
+        the (path, wd) entry is appended to it instead of being inserted in
+        the path index, the caller must then index these entries.
         """
         path = self.__format_path(path)
-        if auto_add and not mask & IN_CREATE:
-            mask |= IN_CREATE
         wd = self._inotify_wrapper.inotify_add_watch(self._fd, path, mask)
         if wd < 0:
             return wd
         watch = Watch(wd=wd, path=path, mask=mask, proc_fun=proc_fun,
                       auto_add=auto_add, exclude_filter=exclude_filter)
         # wd are _always_ indexed with their original unicode paths in wmd.
+        old = self._wmd.get(wd)
         self._wmd[wd] = watch
+        if old is not None and old.path != path:
+            # Same inode watched again from another path.
+            self.__unindex_watch()
+        if pending is None:
+            self.__index_watch(watch)
+        else:
+            pending.append((path, wd))
         log.debug('New %s', watch)
         return wd
 
@@ -1927,29 +2461,44 @@ class WatchManager:
         if exclude_filter is None:
             exclude_filter = self._exclude_filter
 
+        if auto_add and not mask & IN_CREATE:
+            mask |= IN_CREATE
+
+        # Bound once, called for every (sub)directory to watch.
+        add_watch_ = self.__add_watch
+        str_errno = self._inotify_wrapper.str_errno
+
         # normalize args as list elements
         for npath in self.__format_param(path):
             # unix pathname pattern expansion
             for apath in self.__glob(npath, do_glob):
-                # recursively list subdirs according to rec param
+                # recursively list subdirs according to rec param and
+                # filter them in one pass before adding their watches
+                rpaths = []
                 for rpath in self.__walk_rec(apath, rec):
-                    if not exclude_filter(rpath):
-                        wd = ret_[rpath] = self.__add_watch(rpath, mask,
-                                                            proc_fun,
-                                                            auto_add,
-                                                            exclude_filter)
+                    if exclude_filter(rpath):
+                        # Let's say -2 means 'explicitely excluded
+                        # from watching'.
+                        ret_[rpath] = -2
+                    else:
+                        rpaths.append(rpath)
+
+                # The new watches are inserted at once in the path index.
+                pending = []
+                try:
+                    for rpath in rpaths:
+                        wd = ret_[rpath] = add_watch_(rpath, mask, proc_fun,
+                                                      auto_add, exclude_filter,
+                                                      pending)
                         if wd < 0:
                             err = ('add_watch: cannot watch %s WD=%d, %s' % \
-                                       (rpath, wd,
-                                        self._inotify_wrapper.str_errno()))
+                                       (rpath, wd, str_errno()))
                             if quiet:
                                 log.error(err)
                             else:
                                 raise WatchManagerError(err, ret_)
-                    else:
-                        # Let's say -2 means 'explicitely excluded
-                        # from watching'.
-                        ret_[rpath] = -2
+                finally:
+                    self.__index_watches(pending)
         return ret_
 
     def __get_sub_rec(self, lpath):
@@ -1975,17 +2524,10 @@ class WatchManager:
             if not os.path.isdir(root):
                 continue
 
-            # normalization
-            root = os.path.normpath(root)
-            # recursion
-            lend = len(root)
-            for iwd in self._wmd.items():
-                cur = iwd[1].path
-                pref = os.path.commonprefix([root, cur])
-                if root == os.sep or (len(pref) == lend and \
-                                      len(cur) > lend and \
-                                      cur[lend] == os.sep):
-                    yield iwd[1].wd
+            # recursion, a list is returned thus the caller may remove
+            # watches in between
+            for watch_ in self._get_sub_watches(os.path.normpath(root)):
+                yield watch_.wd
 
     def update_watch(self, wd, mask=None, proc_fun=None, rec=False,
                      auto_add=False, quiet=True):
@@ -2063,20 +2605,24 @@ class WatchManager:
         """
         @param param: Parameter.
         @type param: string or int
-        @return: wrap param.
+        @return: wrap param, param itself if it is already a list.
         @rtype: list of type(param)
         """
         if isinstance(param, list):
-            for p_ in param:
-                yield p_
-        else:
-            yield param
+            return param
+        return [param]
 
     def get_wd(self, path):
         """
-        Returns the watch descriptor associated to path. This method
-        presents a prohibitive cost, always prefer to keep the WD
-        returned by add_watch(). If the path is unknown it returns None.
+        Returns the watch descriptor associated to path. The lookup is
+        done in the path index, in O(log(number of watches)), and the
+        watch found is checked against the watch manager dictionary. If
+        the path is unknown it returns None.
+
+        The path index is only kept in sync with the watches by the
+        WatchManager, Watch.path may only be changed through the
+        WatchManager and must not be assigned directly, otherwise the
+        watch could no longer be found from its new path.
 
         @param path: Path.
         @type path: str
@@ -2084,9 +2630,13 @@ class WatchManager:
         @rtype: int or None
         """
         path = self.__format_path(path)
-        for iwd in self._wmd.items():
-            if iwd[1].path == path:
-                return iwd[0]
+        paths = self._paths
+        i = bisect.bisect_left(paths, (path,))
+        while i < len(paths) and paths[i][0] == path:
+            watch_ = self._wmd.get(paths[i][1])
+            if watch_ is not None and watch_.path == path:
+                return watch_.wd
+            i += 1
 
     def get_path(self, wd):
         """
@@ -2115,9 +2665,25 @@ class WatchManager:
         """
         if not rec or os.path.islink(top) or not os.path.isdir(top):
             yield top
-        else:
+        elif scandir is None:
             for root, dirs, files in os.walk(top):
                 yield root
+        else:
+            # Same traversal as os.walk() but only directories are kept and
+            # their type is taken from the directory entries (no stat()).
+            stack = [top]
+            while stack:
+                root = stack.pop()
+                try:
+                    entries = list(scandir(root))
+                except OSError:
+                    # Like os.walk(), skip directories that cannot be listed.
+                    continue
+                yield root
+                subdirs = [entry.path for entry in entries
+                           if entry.is_dir(follow_symlinks=False)]
+                subdirs.reverse()
+                stack.extend(subdirs)
 
     def rm_watch(self, wd, rec=False, quiet=True):
         """
@@ -2155,8 +2721,8 @@ class WatchManager:
                 raise WatchManagerError(err, ret_)
 
             # Remove watch from our dictionary
-            if awd in self._wmd:
-                del self._wmd[awd]
+            if self._wmd.pop(awd, None) is not None:
+                self.__unindex_watch()
             ret_[awd] = True
             log.debug('Watch WD=%d (%s) removed', awd, self.get_path(awd))
         return ret_
@@ -2186,17 +2752,15 @@ class WatchManager:
         @return: Same as add_watch().
         @rtype: Same as add_watch().
         """
-        dirname = os.path.dirname(filename)
+        dirname, basename = os.path.split(filename)
         if dirname == '':
             return {}  # Maintains coherence with add_watch()
-        basename = os.path.basename(filename)
         # Assuming we are watching at least for IN_CREATE and IN_DELETE
         mask |= IN_CREATE | IN_DELETE
 
         def cmp_name(event):
-            if getattr(event, 'name') is None:
-                return False
-            return basename == event.name
+            # event.name may be None, it then never equals basename.
+            return event.name == basename
         return self.add_watch(dirname, mask,
                               proc_fun=proc_class(ChainIfTrue(func=cmp_name)),
                               rec=False,
@@ -2223,6 +2787,9 @@ class RawOutputFormat:
     def simple(self, s, attribute):
         if not isinstance(s, str):
             s = str(s)
+        if not self.format:
+            # Nothing to wrap s with.
+            return s
         return (self.format.get(attribute, '') + s +
                 self.format.get('normal', ''))
 
@@ -2277,6 +2844,10 @@ def compatibility_mode():
     for evname in globals():
         if evname.startswith('IN_'):
             setattr(EventsCodes, evname, globals()[evname])
+    # Aliases of maskname and dir, only defined on Event in compatibility
+    # mode.
+    Event.event_name = property(lambda self: self.maskname)
+    Event.is_dir = property(lambda self: self.dir)
     global COMPATIBILITY_MODE
     COMPATIBILITY_MODE = True
 
@@ -2287,6 +2858,7 @@ def command_line():
     monitored. Events monitoring serves forever, type c^c to stop it.
     """
     from optparse import OptionParser
+    import subprocess
 
     usage = "usage: %prog [options] [path1] [path2] [pathn]"
 
@@ -2327,7 +2899,8 @@ def command_line():
     if options.version:
         print(__version__)
 
-    if not options.raw_format:
+    # Escape sequences are only useful when writing to a terminal.
+    if not options.raw_format and sys.stdout.isatty():
         global output_format
         output_format = ColoredOutputFormat()
 
@@ -0,0 +1,32 @@
+# Example: monitors events with a Notifier driven by a selectors loop
+# (epoll on Linux) instead of asyncore.
+#
+import selectors
+import pyinotify
+
+wm = pyinotify.WatchManager()  # Watch Manager
+mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE  # watched events
+
+class EventHandler(pyinotify.ProcessEvent):
+    def process_IN_CREATE(self, event):
+        print("Creating:", event.pathname)
+
+    def process_IN_DELETE(self, event):
+        print("Removing:", event.pathname)
+
+# Events are only read when the selector reports the fd as readable.
+notifier = pyinotify.Notifier(wm, EventHandler())
+wdd = wm.add_watch('/tmp', mask, rec=True)
+
+sel = selectors.DefaultSelector()
+sel.register(wm.get_fd(), selectors.EVENT_READ)
+try:
+    while True:
+        for key, events in sel.select():
+            notifier.read_events()
+            notifier.process_events()
+except KeyboardInterrupt:
+    pass
+finally:
+    sel.close()
+    notifier.stop()
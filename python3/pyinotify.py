@@ -64,14 +64,12 @@ import termios
 import array
 import logging
 import atexit
-from collections import deque
-from datetime import datetime, timedelta
+from collections import deque, Counter
 import time
 import re
-import asyncore
+import bisect
 import glob
 import locale
-import subprocess
 
 try:
     from functools import reduce
@@ -84,12 +82,65 @@ try:
 except ImportError:
     ctypes = None
 
+try:
+    import asyncore
+except ImportError:
+    # asyncore was removed from Python 3.12, AsyncNotifier is then not
+    # available.
+    asyncore = None
+
 try:
     import inotify_syscalls
 except ImportError:
     inotify_syscalls = None
 
 
+# Header of struct inotify_event: wd, mask, cookie and len (of name).
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _parse_events_py(buf):
+    """
+    Parse a buffer read from the inotify file descriptor.
+
+    @param buf: Raw content read from the inotify file descriptor.
+    @type buf: bytes
+    @return: List of (wd, mask, cookie, name) tuples.
+    @rtype: list
+    @raise ValueError: If buf ends with a truncated event.
+    """
+    events = []
+    unpack_from = _EVENT_HEADER.unpack_from
+    s_size = _EVENT_HEADER.size
+    size = len(buf)
+    rsum = 0  # counter
+    while rsum + s_size <= size:
+        # Retrieve wd, mask, cookie and fname_len
+        wd, mask, cookie, fname_len = unpack_from(buf, rsum)
+        rsum += s_size
+        if rsum + fname_len > size:
+            raise ValueError('truncated inotify event')
+        # Retrieve name, without its trailing '\0' padding
+        fname = buf[rsum:rsum + fname_len].rstrip(b'\0')
+        events.append((wd, mask, cookie, fname))
+        rsum += fname_len
+    if rsum != size:
+        # Trailing partial header.
+        raise ValueError('truncated inotify event')
+    return events
+
+# Use the C parser when the extension module provides it.
+_parse_events = getattr(inotify_syscalls, 'parse_events', None) or \
+    _parse_events_py
+
+
+# Clock used to measure durations, not affected by system time updates.
+_clock = getattr(time, 'monotonic', time.time)
+
+# Encoding of file names, it does not change once the interpreter is started.
+_FS_ENCODING = sys.getfilesystemencoding()
+
+
 __author__ = "seb@dbzteam.org (Sebastien Martini)"
 
 __version__ = "0.9.6"
@@ -197,6 +248,10 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
     def __init__(self):
         self._libc = None
         self._get_errno_func = None
+        self._has_init1 = False
+        # Cached function pointers, see init().
+        self._add_watch_func = None
+        self._rm_watch_func = None
 
     def init(self):
         assert ctypes
@@ -227,6 +282,17 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
         self._libc.inotify_add_watch.restype = ctypes.c_int
         self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
         self._libc.inotify_rm_watch.restype = ctypes.c_int
+        # Saves an attribute lookup on the CDLL object for each call.
+        self._add_watch_func = self._libc.inotify_add_watch
+        self._rm_watch_func = self._libc.inotify_rm_watch
+        # inotify_init1() (Linux >= 2.6.27) directly creates a close-on-exec
+        # file descriptor. IN_CLOEXEC has the value of O_CLOEXEC (Linux and
+        # libinotify).
+        if (hasattr(self._libc, 'inotify_init1') and
+            hasattr(os, 'O_CLOEXEC')):
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_init1.restype = ctypes.c_int
+            self._has_init1 = True
         return True
 
     def _get_errno(self):
@@ -235,21 +301,32 @@ class _CtypesLibcINotifyWrapper(INotifyWrapper):
 
     def _inotify_init(self):
         assert self._libc is not None
-        return self._libc.inotify_init()
+        if self._has_init1:
+            # IN_CLOEXEC | IN_NONBLOCK
+            fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd != -1 or self._get_errno() not in (errno.ENOSYS,
+                                                     errno.EINVAL):
+                return fd
+            # Provided by libc but not by the running kernel (ENOSYS) or
+            # flags not supported (EINVAL).
+            self._has_init1 = False
+        fd = self._libc.inotify_init()
+        if fd != -1:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return fd
 
     def _inotify_add_watch(self, fd, pathname, mask):
         assert self._libc is not None
-        # Encodes path to a bytes string. This conversion seems required because
-        # ctypes.create_string_buffer seems to manipulate bytes internally.
-        # Moreover it seems that inotify_add_watch does not work very well when
-        # it receives an ctypes.create_unicode_buffer instance as argument.
-        pathname = pathname.encode(sys.getfilesystemencoding())
-        pathname = ctypes.create_string_buffer(pathname)
-        return self._libc.inotify_add_watch(fd, pathname, mask)
+        # Encodes path to a bytes string. inotify_add_watch does not work very
+        # well when it receives an unicode string as argument. Its argtypes
+        # were set in init(), thus ctypes directly passes the bytes object as
+        # a char pointer without requiring an intermediate string buffer.
+        pathname = pathname.encode(_FS_ENCODING)
+        return self._add_watch_func(fd, pathname, mask)
 
     def _inotify_rm_watch(self, fd, wd):
         assert self._libc is not None
-        return self._libc.inotify_rm_watch(fd, wd)
+        return self._rm_watch_func(fd, wd)
 
 
 # Logging
@@ -425,6 +502,9 @@ class EventsCodes:
         @return: event name.
         @rtype: str
         """
+        name = EventsCodes._MASKNAMES.get(mask)
+        if name is not None:
+            return name
         ms = mask
         name = '%s'
         if mask & IN_ISDIR:
@@ -458,6 +538,22 @@ ALL_EVENTS = reduce(lambda x, y: x | y, EventsCodes.OP_FLAGS.values())
 EventsCodes.ALL_FLAGS['ALL_EVENTS'] = ALL_EVENTS
 EventsCodes.ALL_VALUES[ALL_EVENTS] = 'ALL_EVENTS'
 
+# Events raised against the watched item itself.
+_SELF_MASK = IN_DELETE_SELF | IN_MOVE_SELF
+
+# Size of the buffer used to read events when no threshold is set, it is
+# much larger than the biggest event.
+_READ_SIZE = 65536
+# Size of the biggest event: 16 bytes + NAME_MAX + 1.
+_MAX_EVENT_SIZE = 16 + 256
+
+# Precomputed event names, with and without IN_ISDIR, see maskname().
+EventsCodes._MASKNAMES = {}
+for valc, namec in EventsCodes.ALL_VALUES.items():
+    EventsCodes._MASKNAMES[valc] = namec
+    if not valc & IN_ISDIR:
+        EventsCodes._MASKNAMES[valc | IN_ISDIR] = namec + '|IN_ISDIR'
+
 
 class _Event:
     """
@@ -465,6 +561,8 @@ class _Event:
     is the base class and should be subclassed.
 
     """
+    __slots__ = ()
+
     def __init__(self, dict_):
         """
         Attach attributes (contained in dict_) to self.
@@ -480,23 +578,38 @@ class _Event:
         @return: Generic event string representation.
         @rtype: str
         """
-        s = ''
-        for attr, value in sorted(self.__dict__.items(), key=lambda x: x[0]):
+        field_name = output_format.field_name
+        field_value = output_format.field_value
+        punctuation = output_format.punctuation
+        equal = punctuation('=')
+        if hasattr(self, '__dict__'):
+            items = list(self.__dict__.items())
+            if COMPATIBILITY_MODE:
+                # These aliases are properties, see compatibility_mode().
+                for attr in ('event_name', 'is_dir'):
+                    try:
+                        items.append((attr, getattr(self, attr)))
+                    except AttributeError:
+                        pass
+            items.sort()
+        else:
+            items = [(attr, getattr(self, attr))
+                     for attr in sorted(self.__slots__)]
+        fields = []
+        for attr, value in items:
             if attr.startswith('_'):
                 continue
             if attr == 'mask':
-                value = hex(getattr(self, attr))
+                value = hex(value)
             elif isinstance(value, str) and not value:
                 value = "''"
-            s += ' %s%s%s' % (output_format.field_name(attr),
-                              output_format.punctuation('='),
-                              output_format.field_value(value))
-
-        s = '%s%s%s %s' % (output_format.punctuation('<'),
-                           output_format.class_name(self.__class__.__name__),
-                           s,
-                           output_format.punctuation('>'))
-        return s
+            fields.append(' %s%s%s' % (field_name(attr), equal,
+                                       field_value(value)))
+
+        return '%s%s%s %s' % (punctuation('<'),
+                              output_format.class_name(self.__class__.__name__),
+                              ''.join(fields),
+                              punctuation('>'))
 
     def __str__(self):
         return repr(self)
@@ -507,6 +620,8 @@ class _RawEvent(_Event):
     Raw event, it contains only the informations provided by the system.
     It doesn't infer anything.
     """
+    __slots__ = ('wd', 'mask', 'cookie', 'name', '_str')
+
     def __init__(self, wd, mask, cookie, name):
         """
         @param wd: Watch Descriptor.
@@ -524,13 +639,13 @@ class _RawEvent(_Event):
         # Use this variable to cache the result of str(self), this object
         # is immutable.
         self._str = None
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
         # name: remove trailing '\0'
-        d = {'wd': wd,
-             'mask': mask,
-             'cookie': cookie,
-             'name': name.rstrip('\0')}
-        _Event.__init__(self, d)
-        log.debug(str(self))
+        self.name = name.rstrip('\0')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(str(self))
 
     def __str__(self):
         if self._str is None:
@@ -568,10 +683,13 @@ class Event(_Event):
         """
         Concretely, this is the raw event plus inferred infos.
         """
-        _Event.__init__(self, raw)
+        # Unlike _RawEvent, Event instances have a __dict__, it is filled
+        # at once instead of through one setattr() call per attribute.
+        self.__dict__.update(raw)
         self.maskname = EventsCodes.maskname(self.mask)
-        if COMPATIBILITY_MODE:
-            self.event_name = self.maskname
+        if 'pathname' in raw:
+            # Already provided (see _SysProcessEvent.process_default).
+            return
         try:
             if self.name:
                 self.pathname = os.path.abspath(os.path.join(self.path,
@@ -600,6 +718,11 @@ class _ProcessEvent:
     """
     Abstract processing event class.
     """
+    # Lazily filled {event mask: bound processing method} memo. Note that
+    # process_* methods bound after the first event of a given mask has
+    # been dispatched are not taken into account for that mask.
+    __methods = None
+
     def __call__(self, event):
         """
         To behave like a functor the object must be callable.
@@ -619,7 +742,39 @@ class _ProcessEvent:
         @raise ProcessEventError: Event object undispatchable,
                                   unknown event.
         """
-        stripped_mask = event.mask - (event.mask & IN_ISDIR)
+        return self._get_method(event.mask)(event)
+
+    def _get_method(self, mask):
+        """
+        Get the processing method associated to mask, it is resolved by
+        _lookup_method() the first time and memoized afterward.
+
+        @param mask: Event mask.
+        @type mask: int
+        @return: Bound processing method.
+        @rtype: callable
+        @raise ProcessEventError: Unknown event.
+        """
+        methods = self.__methods
+        if methods is None:
+            methods = self.__methods = {}
+        meth = methods.get(mask)
+        if meth is None:
+            stripped_mask = mask - (mask & IN_ISDIR)
+            meth = methods[mask] = self._lookup_method(stripped_mask)
+        return meth
+
+    def _lookup_method(self, stripped_mask):
+        """
+        Resolve the processing method associated to stripped_mask, see
+        __call__() for the lookup order.
+
+        @param stripped_mask: Event mask without IN_ISDIR.
+        @type stripped_mask: int
+        @return: Bound processing method.
+        @rtype: callable
+        @raise ProcessEventError: Unknown event.
+        """
         maskname = EventsCodes.ALL_VALUES.get(stripped_mask)
         if maskname is None:
             raise ProcessEventError("Unknown mask 0x%08x" % stripped_mask)
@@ -627,18 +782,38 @@ class _ProcessEvent:
         # 1- look for process_MASKNAME
         meth = getattr(self, 'process_' + maskname, None)
         if meth is not None:
-            return meth(event)
+            return meth
         # 2- look for process_FAMILY_NAME
         meth = getattr(self, 'process_IN_' + maskname.split('_')[1], None)
         if meth is not None:
-            return meth(event)
+            return meth
         # 3- default call method process_default
-        return self.process_default(event)
+        return self.process_default
 
     def __repr__(self):
         return '<%s>' % self.__class__.__name__
 
 
+def _list_dir_types(path):
+    """
+    Yields (name, is_file, is_dir) for each entry of directory path,
+    is_file and is_dir both follow symlinks. When available os.scandir()
+    is used, it provides the type of most entries without stat() calls.
+
+    @param path: Directory path.
+    @type path: str
+    @raise OSError: If path cannot be listed.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            yield entry.name, entry.is_file(), entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            inner = os.path.join(path, name)
+            is_file = os.path.isfile(inner)
+            yield name, is_file, not is_file and os.path.isdir(inner)
+
+
 class _SysProcessEvent(_ProcessEvent):
     """
     There is three kind of processing according to each event:
@@ -659,22 +834,54 @@ class _SysProcessEvent(_ProcessEvent):
         """
         self._watch_manager = wm  # watch manager
         self._notifier = notifier  # notifier
-        self._mv_cookie = {}  # {cookie(int): (src_path(str), date), ...}
-        self._mv = {}  # {src_path(str): (dst_path(str), date), ...}
+        self._mv_cookie = {}  # {cookie(int): (src_path(str), time), ...}
+        self._mv = {}  # {src_path(str): (dst_path(str), time), ...}
+        # Records of both dicts in insertion (i.e. time) order:
+        # [(time, dict, key), ...]
+        self._mv_records = deque()
+
+    def __call__(self, raw_event, watch_=None):
+        """
+        Same dispatch than _ProcessEvent.__call__() except that the Watch
+        associated to raw_event is passed along to the processing method,
+        the caller usually already has it at hand.
+
+        @param raw_event: Event to be processed.
+        @type raw_event: _RawEvent instance
+        @param watch_: Watch of raw_event.wd, looked up if not provided.
+        @type watch_: Watch instance
+        @return: Processed event.
+        @rtype: Event instance
+        """
+        if watch_ is None:
+            watch_ = self._watch_manager.get_watch(raw_event.wd)
+        return self._get_method(raw_event.mask)(raw_event, watch_)
 
     def cleanup(self):
         """
         Cleanup (delete) old (>1mn) records contained in self._mv_cookie
         and self._mv.
         """
-        date_cur_ = datetime.now()
-        for seq in (self._mv_cookie, self._mv):
-            for k in list(seq.keys()):
-                if (date_cur_ - seq[k][1]) > timedelta(minutes=1):
-                    log.debug('Cleanup: deleting entry %s', seq[k][0])
-                    del seq[k]
+        oldest = _clock() - 60  # 1mn
+        records = self._mv_records
+        while records and records[0][0] < oldest:
+            date, seq, key = records.popleft()
+            entry = seq.get(key)
+            # Skip records overwritten since then.
+            if entry is not None and entry[1] == date:
+                log.debug('Cleanup: deleting entry %s', entry[0])
+                del seq[key]
+
+    def __add_mv_record(self, seq, key, path):
+        """
+        Map key to path (+ date for cleaning) in seq, one of self._mv_cookie
+        or self._mv.
+        """
+        date = _clock()
+        seq[key] = (path, date)
+        self._mv_records.append((date, seq, key))
 
-    def process_IN_CREATE(self, raw_event):
+    def process_IN_CREATE(self, raw_event, watch_):
         """
         If the event affects a directory and the auto_add flag of the
         targetted watch is set to True, a new watch is added on this
@@ -682,7 +889,6 @@ class _SysProcessEvent(_ProcessEvent):
         this watch.
         """
         if raw_event.mask & IN_ISDIR:
-            watch_ = self._watch_manager.get_watch(raw_event.wd)
             created_dir = os.path.join(watch_.path, raw_event.name)
             if watch_.auto_add and not watch_.exclude_filter(created_dir):
                 addw = self._watch_manager.add_watch
@@ -701,16 +907,17 @@ class _SysProcessEvent(_ProcessEvent):
                 if ((created_dir_wd is not None) and (created_dir_wd > 0) and
                     os.path.isdir(created_dir)):
                     try:
-                        for name in os.listdir(created_dir):
+                        for name, is_file, is_dir in \
+                                _list_dir_types(created_dir):
                             inner = os.path.join(created_dir, name)
                             if self._watch_manager.get_wd(inner) is not None:
                                 continue
                             # Generate (simulate) creation events for sub-
                             # directories and files.
-                            if os.path.isfile(inner):
+                            if is_file:
                                 # symlinks are handled as files.
                                 flags = IN_CREATE
-                            elif os.path.isdir(inner):
+                            elif is_dir:
                                 flags = IN_CREATE | IN_ISDIR
                             else:
                                 # This path should not be taken.
@@ -719,37 +926,41 @@ class _SysProcessEvent(_ProcessEvent):
                             self._notifier.append_event(rawevent)
                     except OSError as err:
                         msg = "process_IN_CREATE, invalid directory: %s"
-                        log.debug(msg % str(err))
-        return self.process_default(raw_event)
+                        log.debug(msg, err)
+        return self.process_default(raw_event, watch_)
 
-    def process_IN_MOVED_FROM(self, raw_event):
+    def process_IN_MOVED_FROM(self, raw_event, watch_):
         """
         Map the cookie with the source path (+ date for cleaning).
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         path_ = watch_.path
-        src_path = os.path.normpath(os.path.join(path_, raw_event.name))
-        self._mv_cookie[raw_event.cookie] = (src_path, datetime.now())
-        return self.process_default(raw_event, {'cookie': raw_event.cookie})
+        # Watch paths are normalized and the name is a single component,
+        # thus the joined path is already normalized.
+        src_path = os.path.join(path_, raw_event.name)
+        self.__add_mv_record(self._mv_cookie, raw_event.cookie, src_path)
+        event_ = self.process_default(raw_event, watch_)
+        event_.cookie = raw_event.cookie
+        return event_
 
-    def process_IN_MOVED_TO(self, raw_event):
+    def process_IN_MOVED_TO(self, raw_event, watch_):
         """
         Map the source path with the destination path (+ date for
         cleaning).
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         path_ = watch_.path
-        dst_path = os.path.normpath(os.path.join(path_, raw_event.name))
+        # Watch paths are normalized and the name is a single component,
+        # thus the joined path is already normalized.
+        dst_path = os.path.join(path_, raw_event.name)
         mv_ = self._mv_cookie.get(raw_event.cookie)
-        to_append = {'cookie': raw_event.cookie}
+        src_pathname = None
         if mv_ is not None:
-            self._mv[mv_[0]] = (dst_path, datetime.now())
+            self.__add_mv_record(self._mv, mv_[0], dst_path)
             # Let's assume that IN_MOVED_FROM event is always queued before
             # that its associated (they share a common cookie) IN_MOVED_TO
             # event is queued itself. It is then possible in that scenario
             # to provide as additional information to the IN_MOVED_TO event
             # the original pathname of the moved file/directory.
-            to_append['src_pathname'] = mv_[0]
+            src_pathname = mv_[0]
         elif (raw_event.mask & IN_ISDIR and watch_.auto_add and
               not watch_.exclude_filter(dst_path)):
             # We got a diretory that's "moved in" from an unknown source and
@@ -760,9 +971,13 @@ class _SysProcessEvent(_ProcessEvent):
                                           proc_fun=watch_.proc_fun,
                                           rec=True, auto_add=True,
                                           exclude_filter=watch_.exclude_filter)
-        return self.process_default(raw_event, to_append)
+        event_ = self.process_default(raw_event, watch_)
+        event_.cookie = raw_event.cookie
+        if src_pathname is not None:
+            event_.src_pathname = src_pathname
+        return event_
 
-    def process_IN_MOVE_SELF(self, raw_event):
+    def process_IN_MOVE_SELF(self, raw_event, watch_):
         """
         STATUS: the following bug has been fixed in recent kernels (FIXME:
         which version ?). Now it raises IN_DELETE_SELF instead.
@@ -774,23 +989,14 @@ class _SysProcessEvent(_ProcessEvent):
         doesn't bring us enough informations like the destination path of
         moved items.
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
         src_path = watch_.path
         mv_ = self._mv.get(src_path)
         if mv_:
-            dest_path = mv_[0]
-            watch_.path = dest_path
-            # add the separator to the source path to avoid overlapping
-            # path issue when testing with startswith()
-            src_path += os.path.sep
-            src_path_len = len(src_path)
-            # The next loop renames all watches with src_path as base path.
+            # Renames watch_ and all watches with src_path as base path.
             # It seems that IN_MOVE_SELF does not provide IN_ISDIR information
-            # therefore the next loop is iterated even if raw_event is a file.
-            for w in self._watch_manager.watches.values():
-                if w.path.startswith(src_path):
-                    # Note that dest_path is a normalized path.
-                    w.path = os.path.join(dest_path, w.path[src_path_len:])
+            # therefore the sub watches are looked up even if raw_event is a
+            # file.
+            self._watch_manager._move_watch_tree(watch_, mv_[0])
         else:
             log.error("The pathname '%s' of this watch %s has probably changed "
                       "and couldn't be updated, so it cannot be trusted "
@@ -801,49 +1007,53 @@ class _SysProcessEvent(_ProcessEvent):
                       os.path.normpath(os.path.join(watch_.path,
                                                     os.path.pardir)))
             if not watch_.path.endswith('-unknown-path'):
-                watch_.path += '-unknown-path'
-        return self.process_default(raw_event)
+                self._watch_manager._set_watch_path(watch_,
+                                                    watch_.path +
+                                                    '-unknown-path')
+        return self.process_default(raw_event, watch_)
 
-    def process_IN_Q_OVERFLOW(self, raw_event):
+    def process_IN_Q_OVERFLOW(self, raw_event, watch_):
         """
         Only signal an overflow, most of the common flags are irrelevant
         for this event (path, wd, name).
         """
         return Event({'mask': raw_event.mask})
 
-    def process_IN_IGNORED(self, raw_event):
+    def process_IN_IGNORED(self, raw_event, watch_):
         """
         The watch descriptor raised by this event is now ignored (forever),
         it can be safely deleted from the watch manager dictionary.
         After this event we can be sure that neither the event queue nor
         the system will raise an event associated to this wd again.
         """
-        event_ = self.process_default(raw_event)
+        event_ = self.process_default(raw_event, watch_)
         self._watch_manager.del_watch(raw_event.wd)
         return event_
 
-    def process_default(self, raw_event, to_append=None):
+    def process_default(self, raw_event, watch_):
         """
         Commons handling for the followings events:
 
         IN_ACCESS, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_CLOSE_NOWRITE,
         IN_OPEN, IN_DELETE, IN_DELETE_SELF, IN_UNMOUNT.
         """
-        watch_ = self._watch_manager.get_watch(raw_event.wd)
-        if raw_event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        mask = raw_event.mask
+        if mask & _SELF_MASK:
             # Unfornulately this information is not provided by the kernel
             dir_ = watch_.dir
         else:
-            dir_ = bool(raw_event.mask & IN_ISDIR)
+            dir_ = bool(mask & IN_ISDIR)
+        # The name given by the kernel is a single path component, joining
+        # it to the normalized watch path is enough.
+        pathname = watch_._get_abspath()
+        if raw_event.name:
+            pathname = os.path.join(pathname, raw_event.name)
         dict_ = {'wd': raw_event.wd,
-                 'mask': raw_event.mask,
+                 'mask': mask,
                  'path': watch_.path,
                  'name': raw_event.name,
+                 'pathname': pathname,
                  'dir': dir_}
-        if COMPATIBILITY_MODE:
-            dict_['is_dir'] = dir_
-        if to_append is not None:
-            dict_.update(to_append)
         return Event(dict_)
 
 
@@ -983,6 +1193,10 @@ class ChainIfTrue(ProcessEvent):
         return not self._func(event)
 
 
+# {mask: tuple of the event names in its maskname}, shared by Stats instances.
+_maskname_parts = {}
+
+
 class Stats(ProcessEvent):
     """
     Compute and display trivial statistics about processed events.
@@ -991,34 +1205,31 @@ class Stats(ProcessEvent):
         """
         Method automatically called from base class constructor.
         """
-        self._start_time = time.time()
-        self._stats = {}
+        self._start_time = _clock()
+        self._stats = Counter()
         self._stats_lock = threading.Lock()
+        # (key, string) of the last histogram rendered by __str__
+        self._str_cache = (None, '')
 
     def process_default(self, event):
         """
         Processes |event|.
         """
-        self._stats_lock.acquire()
-        try:
-            events = event.maskname.split('|')
-            for event_name in events:
-                count = self._stats.get(event_name, 0)
-                self._stats[event_name] = count + 1
-        finally:
-            self._stats_lock.release()
+        events = _maskname_parts.get(event.mask)
+        if events is None:
+            events = tuple(event.maskname.split('|'))
+            _maskname_parts[event.mask] = events
+        with self._stats_lock:
+            self._stats.update(events)
 
     def _stats_copy(self):
-        self._stats_lock.acquire()
-        try:
-            return self._stats.copy()
-        finally:
-            self._stats_lock.release()
+        with self._stats_lock:
+            return dict(self._stats)
 
     def __repr__(self):
         stats = self._stats_copy()
 
-        elapsed = int(time.time() - self._start_time)
+        elapsed = int(_clock() - self._start_time)
         elapsed_str = ''
         if elapsed < 60:
             elapsed_str = str(elapsed) + 'sec'
@@ -1031,7 +1242,7 @@ class Stats(ProcessEvent):
         stats['ElapsedTime'] = elapsed_str
 
         l = []
-        for ev, value in sorted(stats.items(), key=lambda x: x[0]):
+        for ev, value in sorted(stats.items()):
             l.append(' %s=%s' % (output_format.field_name(ev),
                                  output_format.field_value(value)))
         s = '<%s%s >' % (output_format.class_name(self.__class__.__name__),
@@ -1056,15 +1267,25 @@ class Stats(ProcessEvent):
         if not stats:
             return ''
 
+        items = sorted(stats.items())
+        # Rendering only depends on the counters, the scale and the current
+        # output format, reuse the previous string if none of them changed.
+        key = (tuple(items), scale, output_format)
+        if self._str_cache[0] == key:
+            return self._str_cache[1]
+
         m = max(stats.values())
         unity = scale / m
         fmt = '%%-26s%%-%ds%%s' % (len(output_format.field_value('@' * scale))
                                    + 1)
-        def func(x):
-            return fmt % (output_format.field_name(x[0]),
-                          output_format.field_value('@' * int(x[1] * unity)),
-                          output_format.simple('%d' % x[1], 'yellow'))
-        s = '\n'.join(map(func, sorted(stats.items(), key=lambda x: x[0])))
+        field_name = output_format.field_name
+        field_value = output_format.field_value
+        simple = output_format.simple
+        s = '\n'.join([fmt % (field_name(name),
+                              field_value('@' * int(count * unity)),
+                              simple('%d' % count, 'yellow'))
+                       for name, count in items])
+        self._str_cache = (key, s)
         return s
 
 
@@ -1087,7 +1308,7 @@ class Notifier:
 
     """
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None):
+                 threshold=0, timeout=None, eventq_maxlen=None):
         """
         Initialization. read_freq, threshold and timeout parameters are used
         when looping.
@@ -1115,18 +1336,38 @@ class Notifier:
                         milliseconds. See
                         https://docs.python.org/3/library/select.html#select.poll.poll
         @type timeout: int
+        @param eventq_maxlen: Maximum number of events held in the internal
+                              queue between their reading and their
+                              processing. If None (default) the queue is
+                              unbounded. Otherwise when the queue is full the
+                              oldest events are dropped and accounted in
+                              dropped_events.
+        @type eventq_maxlen: int
         """
         # Watch Manager instance
         self._watch_manager = watch_manager
         # File descriptor
         self._fd = self._watch_manager.get_fd()
-        # Poll object and registration
-        self._pollobj = select.poll()
-        self._pollobj.register(self._fd, select.POLLIN)
+        # Poll object and registration, epoll is used where available
+        # (Linux), poll otherwise (e.g. FreeBSD with libinotify). Both are
+        # level-triggered, events may be left unread when threshold is used.
+        self._epoll = hasattr(select, 'epoll')
+        if self._epoll:
+            self._pollobj = select.epoll()
+            self._pollin = select.EPOLLIN
+        else:
+            self._pollobj = select.poll()
+            self._pollin = select.POLLIN
+        self._pollobj.register(self._fd, self._pollin)
         # This pipe is correctely initialized and used by ThreadedNotifier
         self._pipe = (-1, -1)
-        # Event queue
-        self._eventq = deque()
+        # Event queue, optionally bounded
+        if eventq_maxlen is None:
+            self._eventq = deque()
+        else:
+            self._eventq = deque(maxlen=eventq_maxlen)
+        # Number of events dropped from the bounded event queue
+        self._dropped = 0
         # System processing functor, common to all events
         self._sys_proc_fun = _SysProcessEvent(self._watch_manager, self)
         # Default processing method
@@ -1149,7 +1390,25 @@ class Notifier:
         @param event: An event.
         @type event: _RawEvent instance.
         """
+        before = len(self._eventq)
         self._eventq.append(event)
+        if len(self._eventq) == before:
+            self._account_dropped(1)
+
+    def _account_dropped(self, count):
+        self._dropped += count
+        log.warning('Event queue full, %d event(s) dropped.', count)
+
+    @property
+    def dropped_events(self):
+        """
+        Number of events dropped so far because the bounded event queue
+        was full (see eventq_maxlen).
+
+        @return: Count of dropped events.
+        @rtype: int
+        """
+        return self._dropped
 
     def proc_fun(self):
         return self._default_proc_fun
@@ -1191,7 +1450,13 @@ class Notifier:
                 # blocks up to 'timeout' milliseconds
                 if timeout is None:
                     timeout = self._timeout
-                ret = self._pollobj.poll(timeout)
+                if not self._epoll:
+                    ret = self._pollobj.poll(timeout)
+                # epoll's timeout is in seconds, -1 blocks indefinitely
+                elif timeout is None:
+                    ret = self._pollobj.poll(-1)
+                else:
+                    ret = self._pollobj.poll(timeout / 1000.0)
             except select.error as err:
                 if err.args[0] == errno.EINTR:
                     continue # interrupted, retry
@@ -1203,50 +1468,80 @@ class Notifier:
         if not ret or (self._pipe[0] == ret[0][0]):
             return False
         # only one fd is polled
-        return ret[0][1] & select.POLLIN
+        return ret[0][1] & self._pollin
 
     def read_events(self):
         """
         Read events from device, build _RawEvents, and enqueue them.
+
+        @return: True if events were read and the read buffer could not
+                 hold another event, in which case more events are likely
+                 pending (burst), False otherwise.
+        @rtype: bool
         """
-        buf_ = array.array('i', [0])
-        # get event queue size
-        if fcntl.ioctl(self._fd, termios.FIONREAD, buf_, 1) == -1:
-            return
-        queue_size = buf_[0]
-        if queue_size < self._threshold:
-            log.debug('(fd: %d) %d bytes available to read but threshold is '
-                      'fixed to %d bytes', self._fd, queue_size,
-                      self._threshold)
-            return
+        if self._threshold:
+            buf_ = array.array('i', [0])
+            # get event queue size
+            if fcntl.ioctl(self._fd, termios.FIONREAD, buf_, 1) == -1:
+                return False
+            queue_size = buf_[0]
+            if queue_size < self._threshold:
+                log.debug('(fd: %d) %d bytes available to read but threshold '
+                          'is fixed to %d bytes', self._fd, queue_size,
+                          self._threshold)
+                return False
+            if not queue_size:
+                return False
+        else:
+            # No need to query the event queue size, the file descriptor
+            # is non-blocking (see WatchManager.get_fd()), reading an empty
+            # queue fails with EAGAIN.
+            queue_size = _READ_SIZE
 
         try:
             # Read content from file
             r = os.read(self._fd, queue_size)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return False
+            raise NotifierError(err)
         except Exception as msg:
             raise NotifierError(msg)
-        log.debug('Event queue size: %d', queue_size)
-        rsum = 0  # counter
-        while rsum < queue_size:
-            s_size = 16
-            # Retrieve wd, mask, cookie and fname_len
-            wd, mask, cookie, fname_len = struct.unpack('iIII',
-                                                        r[rsum:rsum+s_size])
-            # Retrieve name
-            bname, = struct.unpack('%ds' % fname_len,
-                                   r[rsum + s_size:rsum + s_size + fname_len])
-            # FIXME: should we explictly call sys.getdefaultencoding() here ??
-            uname = bname.decode()
-            rawevent = _RawEvent(wd, mask, cookie, uname)
-            if self._coalesce:
-                # Only enqueue new (unique) events.
-                raweventstr = str(rawevent)
-                if raweventstr not in self._eventset:
-                    self._eventset.add(raweventstr)
-                    self._eventq.append(rawevent)
-            else:
-                self._eventq.append(rawevent)
-            rsum += s_size + fname_len
+        if not r:
+            return False
+        log.debug('Event queue size: %d', len(r))
+        try:
+            events = _parse_events(r)
+        except ValueError as err:
+            # Same error from the C and the Python parsers.
+            raise NotifierError(err)
+        eventq = self._eventq
+        before = len(eventq)
+        # FIXME: should we explictly call sys.getdefaultencoding() here ??
+        if self._coalesce:
+            eventset = self._eventset
+            batch = []
+            for event in events:
+                # Only enqueue new (unique) events, the parsed
+                # (wd, mask, cookie, name) tuple identifies them.
+                if event not in eventset:
+                    eventset.add(event)
+                    wd, mask, cookie, bname = event
+                    batch.append(_RawEvent(wd, mask, cookie, bname.decode()))
+        else:
+            batch = [_RawEvent(wd, mask, cookie, bname.decode())
+                     for wd, mask, cookie, bname in events]
+        eventq.extend(batch)
+        pushed = len(batch)
+        dropped = before + pushed - len(eventq)
+        if dropped > 0:
+            self._account_dropped(dropped)
+        # With a threshold the whole queue was read at once. Otherwise
+        # re-reading is only worth it if the buffer was full, returning True
+        # after any read would skip check_events() (and its timeout) as long
+        # as events trickle in.
+        return (not self._threshold and
+                _READ_SIZE - len(r) < _MAX_EVENT_SIZE)
 
     def process_events(self):
         """
@@ -1254,12 +1549,24 @@ class Notifier:
         associated proccessing method (an instance of ProcessEvent).
         It also does internal processings, to keep the system updated.
         """
-        while self._eventq:
-            raw_event = self._eventq.popleft()  # pop next event
-            if self._watch_manager.ignore_events:
-                log.debug("Event ignored: %s" % repr(raw_event))
+        eventq = self._eventq
+        watch_manager = self._watch_manager
+        get_watch = watch_manager.get_watch
+        sys_proc_fun = self._sys_proc_fun
+        default_proc_fun = self._default_proc_fun
+        if watch_manager.ignore_events:
+            # Drop the whole batch at once.
+            if log.isEnabledFor(logging.DEBUG):
+                for raw_event in eventq:
+                    log.debug("Event ignored: %r", raw_event)
+            eventq.clear()
+        while eventq:
+            raw_event = eventq.popleft()  # pop next event
+            if watch_manager.ignore_events:
+                # Set from a processing function.
+                log.debug("Event ignored: %r", raw_event)
                 continue
-            watch_ = self._watch_manager.get_watch(raw_event.wd)
+            watch_ = get_watch(raw_event.wd)
             if (watch_ is None) and not (raw_event.mask & IN_Q_OVERFLOW):
                 if not (raw_event.mask & IN_IGNORED):
                     # Not really sure how we ended up here, nor how we should
@@ -1268,12 +1575,12 @@ class Notifier:
                     log.warning("Unable to retrieve Watch object associated to %s",
                                 repr(raw_event))
                 continue
-            revent = self._sys_proc_fun(raw_event)  # system processings
-            if watch_ and watch_.proc_fun:
-                watch_.proc_fun(revent)  # user processings
-            else:
-                self._default_proc_fun(revent)
-        self._sys_proc_fun.cleanup()  # remove olds MOVED_* events records
+            revent = sys_proc_fun(raw_event, watch_)  # system processings
+            # user processings, the watch's own processing function if it has
+            # one, the default one otherwise
+            proc_fun = watch_ and watch_.proc_fun or default_proc_fun
+            proc_fun(revent)
+        sys_proc_fun.cleanup()  # remove olds MOVED_* events records
         if self._coalesce:
             self._eventset.clear()
 
@@ -1316,12 +1623,15 @@ class Notifier:
                 # parent 1
                 os._exit(0)
 
-            fd_inp = os.open(stdin, os.O_RDONLY)
-            os.dup2(fd_inp, 0)
-            fd_out = os.open(stdout, os.O_WRONLY|os.O_CREAT, 0o0600)
-            os.dup2(fd_out, 1)
-            fd_err = os.open(stderr, os.O_WRONLY|os.O_CREAT, 0o0600)
-            os.dup2(fd_err, 2)
+            # Append to existing files rather than overwriting them in place.
+            flags = os.O_WRONLY|os.O_CREAT|os.O_APPEND
+            for path, oflags, std_fd in ((stdin, os.O_RDONLY, 0),
+                                         (stdout, flags, 1),
+                                         (stderr, flags, 2)):
+                fd = os.open(path, oflags, 0o0600)
+                if fd != std_fd:
+                    os.dup2(fd, std_fd)
+                    os.close(fd)
 
         # Detach task
         fork_daemon()
@@ -1330,16 +1640,15 @@ class Notifier:
         if pid_file != False:
             flags = os.O_WRONLY|os.O_CREAT|os.O_NOFOLLOW|os.O_EXCL
             fd_pid = os.open(pid_file, flags, 0o0600)
-            os.write(fd_pid,  bytes(str(os.getpid()) + '\n',
-                                    locale.getpreferredencoding()))
+            os.write(fd_pid, ('%d\n' % os.getpid()).encode('ascii'))
             os.close(fd_pid)
             # Register unlink function
-            atexit.register(lambda : os.unlink(pid_file))
+            atexit.register(os.unlink, pid_file)
 
     def _sleep(self, ref_time):
         # Only consider sleeping if read_freq is > 0
         if self._read_freq > 0:
-            cur_time = time.time()
+            cur_time = _clock()
             sleep_amount = self._read_freq - (cur_time - ref_time)
             if sleep_amount > 0:
                 log.debug('Now sleeping %d seconds', sleep_amount)
@@ -1374,16 +1683,27 @@ class Notifier:
             self.__daemonize(**args)
 
         # Read and process events forever
+        process_events = self.process_events
+        check_events = self.check_events
+        read_events = self.read_events
+        sleep = self._sleep
+        more = False
         while 1:
             try:
-                self.process_events()
+                process_events()
                 if (callback is not None) and (callback(self) is True):
                     break
-                ref_time = time.time()
-                # check_events is blocking
-                if self.check_events():
-                    self._sleep(ref_time)
-                    self.read_events()
+                ref_time = _clock()
+                # check_events is blocking, it is skipped after a read that
+                # filled the buffer because under a burst more events are
+                # likely pending, read_events returns False without reading
+                # if there are not. Nor is read_freq slept again before these
+                # re-reads.
+                if more:
+                    more = read_events()
+                elif check_events():
+                    sleep(ref_time)
+                    more = read_events()
             except KeyboardInterrupt:
                 # Stop monitoring if sigint is caught (Control-C).
                 log.debug('Pyinotify stops monitoring.')
@@ -1400,6 +1720,8 @@ class Notifier:
         """
         if self._fd is not None:
             self._pollobj.unregister(self._fd)
+            if self._epoll:
+                self._pollobj.close()
             os.close(self._fd)
             self._fd = None
         self._sys_proc_fun = None
@@ -1415,7 +1737,7 @@ class ThreadedNotifier(threading.Thread, Notifier):
     it is not threaded and could be easily daemonized.
     """
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None):
+                 threshold=0, timeout=None, eventq_maxlen=None):
         """
         Initialization, initialize base classes. read_freq, threshold and
         timeout parameters are used when looping.
@@ -1440,6 +1762,8 @@ class ThreadedNotifier(threading.Thread, Notifier):
                         milliseconds. See
                         https://docs.python.org/3/library/select.html#select.poll.poll
         @type timeout: int
+        @param eventq_maxlen: Optional event queue bound. See base class.
+        @type eventq_maxlen: int
         """
         # Init threading base class
         threading.Thread.__init__(self)
@@ -1447,22 +1771,32 @@ class ThreadedNotifier(threading.Thread, Notifier):
         self._stop_event = threading.Event()
         # Init Notifier base class
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
-        # Create a new pipe used for thread termination
-        self._pipe = os.pipe()
-        self._pollobj.register(self._pipe[0], select.POLLIN)
+                          threshold, timeout, eventq_maxlen)
+        # Create a new pipe used for thread termination. When available an
+        # eventfd object is used instead, both of its ends are then the same
+        # file descriptor.
+        if hasattr(os, 'eventfd'):
+            efd = os.eventfd(0, os.EFD_CLOEXEC)
+            self._pipe = (efd, efd)
+        else:
+            self._pipe = os.pipe()
+        self._pollobj.register(self._pipe[0], self._pollin)
 
     def stop(self):
         """
         Stop notifier's loop. Stop notification. Join the thread.
         """
         self._stop_event.set()
-        os.write(self._pipe[1], b'stop')
+        if self._pipe[0] == self._pipe[1]:
+            os.eventfd_write(self._pipe[1], 1)
+        else:
+            os.write(self._pipe[1], b'stop')
         threading.Thread.join(self)
-        Notifier.stop(self)
         self._pollobj.unregister(self._pipe[0])
+        Notifier.stop(self)
         os.close(self._pipe[0])
-        os.close(self._pipe[1])
+        if self._pipe[1] != self._pipe[0]:
+            os.close(self._pipe[1])
 
     def loop(self):
         """
@@ -1473,15 +1807,25 @@ class ThreadedNotifier(threading.Thread, Notifier):
         seconds at best and only if the size of events to read is >= threshold.
         """
         # When the loop must be terminated .stop() is called, 'stop'
-        # is written to pipe fd so poll() returns and .check_events()
-        # returns False which make evaluate the While's stop condition
-        # ._stop_event.isSet() wich put an end to the thread's execution.
-        while not self._stop_event.isSet():
-            self.process_events()
-            ref_time = time.time()
-            if self.check_events():
-                self._sleep(ref_time)
-                self.read_events()
+        # is written to pipe fd (or the eventfd counter is incremented) so
+        # poll() returns and .check_events() returns False which make
+        # evaluate the While's stop condition ._stop_event.isSet() wich put
+        # an end to the thread's execution.
+        stop_is_set = self._stop_event.isSet
+        process_events = self.process_events
+        check_events = self.check_events
+        read_events = self.read_events
+        sleep = self._sleep
+        more = False
+        while not stop_is_set():
+            process_events()
+            ref_time = _clock()
+            # See Notifier.loop() about skipping check_events() and sleep().
+            if more:
+                more = read_events()
+            elif check_events():
+                sleep(ref_time)
+                more = read_events()
 
     def run(self):
         """
@@ -1494,33 +1838,35 @@ class ThreadedNotifier(threading.Thread, Notifier):
         self.loop()
 
 
-class AsyncNotifier(asyncore.file_dispatcher, Notifier):
-    """
-    This notifier inherits from asyncore.file_dispatcher in order to be able to
-    use pyinotify along with the asyncore framework.
-
-    """
-    def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
-                 threshold=0, timeout=None, channel_map=None):
+if asyncore is not None:
+    class AsyncNotifier(asyncore.file_dispatcher, Notifier):
         """
-        Initializes the async notifier. The only additional parameter is
-        'channel_map' which is the optional asyncore private map. See
-        Notifier class for the meaning of the others parameters.
+        This notifier inherits from asyncore.file_dispatcher in order to be
+        able to use pyinotify along with the asyncore framework.
 
         """
-        Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
-        asyncore.file_dispatcher.__init__(self, self._fd, channel_map)
+        def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
+                     threshold=0, timeout=None, channel_map=None,
+                     eventq_maxlen=None):
+            """
+            Initializes the async notifier. The only additional parameter is
+            'channel_map' which is the optional asyncore private map. See
+            Notifier class for the meaning of the others parameters.
 
-    def handle_read(self):
-        """
-        When asyncore tells us we can read from the fd, we proceed processing
-        events. This method can be overridden for handling a notification
-        differently.
+            """
+            Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
+                              threshold, timeout, eventq_maxlen)
+            asyncore.file_dispatcher.__init__(self, self._fd, channel_map)
 
-        """
-        self.read_events()
-        self.process_events()
+        def handle_read(self):
+            """
+            When asyncore tells us we can read from the fd, we proceed
+            processing events. This method can be overridden for handling a
+            notification differently.
+
+            """
+            self.read_events()
+            self.process_events()
 
 
 class TornadoAsyncNotifier(Notifier):
@@ -1530,7 +1876,7 @@ class TornadoAsyncNotifier(Notifier):
     """
     def __init__(self, watch_manager, ioloop, callback=None,
                  default_proc_fun=None, read_freq=0, threshold=0, timeout=None,
-                 channel_map=None):
+                 channel_map=None, eventq_maxlen=None):
         """
         Note that if later you must call ioloop.close() be sure to let the
         default parameter to all_fds=False.
@@ -1547,7 +1893,7 @@ class TornadoAsyncNotifier(Notifier):
         self.io_loop = ioloop
         self.handle_read_callback = callback
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         ioloop.add_handler(self._fd, self.handle_read, ioloop.READ)
 
     def stop(self):
@@ -1572,7 +1918,8 @@ class AsyncioNotifier(Notifier):
 
     """
     def __init__(self, watch_manager, loop, callback=None,
-                 default_proc_fun=None, read_freq=0, threshold=0, timeout=None):
+                 default_proc_fun=None, read_freq=0, threshold=0, timeout=None,
+                 eventq_maxlen=None):
         """
 
         See examples/asyncio_notifier.py for an example usage.
@@ -1588,7 +1935,7 @@ class AsyncioNotifier(Notifier):
         self.loop = loop
         self.handle_read_callback = callback
         Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
-                          threshold, timeout)
+                          threshold, timeout, eventq_maxlen)
         loop.add_reader(self._fd, self.handle_read)
 
     def stop(self):
@@ -1608,7 +1955,7 @@ class Watch:
 
     """
     __slots__ = ('wd', 'path', 'mask', 'proc_fun', 'auto_add',
-                 'exclude_filter', 'dir')
+                 'exclude_filter', 'dir', '_abspath')
 
     def __init__(self, wd, path, mask, proc_fun, auto_add, exclude_filter):
         """
@@ -1616,7 +1963,9 @@ class Watch:
 
         @param wd: Watch descriptor.
         @type wd: int
-        @param path: Path of the file or directory being watched.
+        @param path: Path of the file or directory being watched. Once
+                     the watch is added it may only be changed by the
+                     WatchManager, see WatchManager.get_wd().
         @type path: str
         @param mask: Mask.
         @type mask: int
@@ -1636,12 +1985,31 @@ class Watch:
         self.auto_add = auto_add
         self.exclude_filter = exclude_filter
         self.dir = os.path.isdir(self.path)
+        # (path, absolute path) pair, see _get_abspath().
+        self._abspath = (path, os.path.abspath(path))
+
+    def _get_abspath(self):
+        """
+        @return: Absolute path of the watched item. It is only recomputed
+                 when path is modified (e.g. the watched item was moved).
+        @rtype: str
+        """
+        path = self.path
+        if self._abspath[0] != path:
+            self._abspath = (path, os.path.abspath(path))
+        return self._abspath[1]
 
     def __repr__(self):
         """
         @return: String representation.
         @rtype: str
         """
+        if not output_format.format:
+            # Fast path, no formatting codes to insert.
+            return '<%s %s >' % (self.__class__.__name__,
+                                 ' '.join(['%s=%s' % (attr, getattr(self, attr))
+                                           for attr in self.__slots__
+                                           if not attr.startswith('_')]))
         s = ' '.join(['%s%s%s' % (output_format.field_name(attr),
                                   output_format.punctuation('='),
                                   output_format.field_value(getattr(self,
@@ -1687,6 +2055,27 @@ class ExcludeFilter:
         for regex in lst:
             self._lregex.append(re.compile(regex, re.UNICODE))
 
+        # Try to match all the patterns in a single pass with one
+        # alternation. Patterns with groups (backreferences would be
+        # renumbered) or with differing inline flags are kept apart.
+        self._regex = None
+        if len(self._lregex) > 1:
+            flags = self._lregex[0].flags
+            for regex in self._lregex:
+                if regex.groups or regex.flags != flags:
+                    break
+            else:
+                try:
+                    self._regex = re.compile('|'.join(['(?:%s)' % regex
+                                                       for regex in lst]),
+                                             re.UNICODE)
+                except re.error:
+                    pass
+
+        # Results of __call__(), recursive walks and newly created
+        # directories may lead to test the same paths several times.
+        self._cache = {}  # {path: bool}
+
     def _load_patterns_from_file(self, filename):
         lst = []
         with open(filename, 'r') as file_obj:
@@ -1709,10 +2098,25 @@ class ExcludeFilter:
                  be excluded, False otherwise.
         @rtype: bool
         """
-        for regex in self._lregex:
-            if self._match(regex, path):
-                return True
-        return False
+        if not self._lregex:
+            return False
+        cache = self._cache
+        ret = cache.get(path)
+        if ret is not None:
+            return ret
+        if self._regex is not None:
+            ret = self._match(self._regex, path)
+        else:
+            ret = False
+            for regex in self._lregex:
+                if self._match(regex, path):
+                    ret = True
+                    break
+        # Bounded, simply start over when full.
+        if len(cache) >= 8192:
+            cache.clear()
+        cache[path] = ret
+        return ret
 
 
 class WatchManagerError(Exception):
@@ -1756,6 +2160,13 @@ class WatchManager:
         self._ignore_events = False
         self._exclude_filter = exclude_filter
         self._wmd = {}  # watch dict key: watch descriptor, value: watch
+        # Watches sorted by path: [(path, wd), ...], the watches located
+        # under a given directory are thus contiguous. Entries are not
+        # removed one by one, they become stale when their path no longer
+        # matches the path of the watch of their wd and are dropped all at
+        # once when they make up half of the index.
+        self._paths = []
+        self._stale = 0  # Number of stale entries
 
         self._inotify_wrapper = INotifyWrapper.create()
         if self._inotify_wrapper is None:
@@ -1765,6 +2176,11 @@ class WatchManager:
         if self._fd < 0:
             err = 'Cannot initialize new instance of inotify, %s'
             raise OSError(err % self._inotify_wrapper.str_errno())
+        # Non-blocking file descriptor, if not already created as such
+        # with IN_NONBLOCK.
+        flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+        if not flags & os.O_NONBLOCK:
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
     def close(self):
         """
@@ -1780,7 +2196,9 @@ class WatchManager:
 
     def get_fd(self):
         """
-        Return assigned inotify's file descriptor.
+        Return assigned inotify's file descriptor. It is in non-blocking
+        mode, reading it when no event is pending fails with EAGAIN instead
+        of blocking, wait for it to be readable first (e.g. with poll).
 
         @return: File descriptor.
         @rtype: int
@@ -1804,7 +2222,8 @@ class WatchManager:
         @type wd: int
         """
         try:
-            del self._wmd[wd]
+            self._wmd.pop(wd)
+            self.__unindex_watch()
         except KeyError as err:
             log.error('Cannot delete unknown watch descriptor %s' % str(err))
 
@@ -1818,6 +2237,128 @@ class WatchManager:
         """
         return self._wmd
 
+    def __is_indexed(self, key):
+        paths = self._paths
+        i = bisect.bisect_left(paths, key)
+        return i < len(paths) and paths[i] == key
+
+    def __index_watch(self, watch_):
+        key = (watch_.path, watch_.wd)
+        if not self.__is_indexed(key):
+            bisect.insort(self._paths, key)
+
+    def __index_watches(self, keys):
+        """
+        Insert several (path, wd) entries at once in the path index.
+        """
+        keys = [key for key in keys if not self.__is_indexed(key)]
+        if len(keys) > 1:
+            self._paths.extend(keys)
+            self._paths.sort()
+        elif keys:
+            bisect.insort(self._paths, keys[0])
+
+    def __unindex_watch(self):
+        """
+        Account for an entry of the path index that became stale, to be
+        called once a watch was removed from the watch manager dictionary
+        or its path changed.
+        """
+        self._stale += 1
+        if self._stale > len(self._paths) // 2:
+            wmd = self._wmd
+            live = []
+            for path, wd in self._paths:
+                watch_ = wmd.get(wd)
+                if watch_ is not None and watch_.path == path:
+                    live.append((path, wd))
+            self._paths[:] = live
+            self._stale = 0
+
+    def _set_watch_path(self, watch_, path):
+        """
+        Update the path of watch_, its path must not be modified directly
+        otherwise it would not be kept in sync in the path index.
+
+        @param watch_: Watch to update.
+        @type watch_: Watch instance
+        @param path: New path.
+        @type path: str
+        """
+        watch_.path = path
+        self.__unindex_watch()
+        self.__index_watch(watch_)
+
+    def _move_watch_tree(self, watch_, path):
+        """
+        Update the path of watch_ and rebase the paths of the watches
+        located under its previous path. The entries of these watches are
+        contiguous in the path index and keep their relative order once
+        rebased, they are thus moved at once instead of one by one.
+
+        @param watch_: Watch of the moved directory.
+        @type watch_: Watch instance
+        @param path: New normalized path.
+        @type path: str
+        """
+        src_prefix = watch_.path
+        if not src_prefix.endswith(os.sep):
+            src_prefix += os.sep
+        dest_prefix = path
+        if not dest_prefix.endswith(os.sep):
+            dest_prefix += os.sep
+        self._set_watch_path(watch_, path)
+
+        paths = self._paths
+        i = j = bisect.bisect_left(paths, (src_prefix,))
+        while j < len(paths) and paths[j][0].startswith(src_prefix):
+            j += 1
+        src_len = len(src_prefix)
+        moved = []
+        for path_, wd in paths[i:j]:
+            w = self._wmd.get(wd)
+            if w is not None and w.path == path_:
+                w.path = dest_prefix + path_[src_len:]
+                moved.append((w.path, wd))
+        del paths[i:j]
+        # Stale entries of the subtree were dropped along the way.
+        self._stale = max(0, self._stale - (j - i - len(moved)))
+        if not moved:
+            return
+        k = bisect.bisect_left(paths, moved[0])
+        if k == len(paths) or moved[-1] < paths[k]:
+            paths[k:k] = moved
+        else:
+            # Some watches were already located under the new path.
+            paths.extend(moved)
+            paths.sort()
+
+    def _get_sub_watches(self, path):
+        """
+        Get the watches whose paths are located under path (path excluded),
+        the cost depends on their number, not on the total number of
+        watches.
+
+        @param path: Normalized directory path.
+        @type path: str
+        @return: List of watches.
+        @rtype: list of Watch instances
+        """
+        # The separator is appended to path to avoid overlapping paths
+        # issues when testing with startswith().
+        prefix = path
+        if not prefix.endswith(os.sep):
+            prefix += os.sep
+        paths = self._paths
+        ret = []
+        i = bisect.bisect_left(paths, (prefix,))
+        while i < len(paths) and paths[i][0].startswith(prefix):
+            watch_ = self._wmd.get(paths[i][1])
+            if watch_ is not None and watch_.path == paths[i][0]:
+                ret.append(watch_)
+            i += 1
+        return ret
+
     def __format_path(self, path):
         """
         Format path to its internal (stored in watch manager) representation.
@@ -1825,21 +2366,30 @@ class WatchManager:
         # path must be a unicode string (str) and is just normalized.
         return os.path.normpath(path)
 
-    def __add_watch(self, path, mask, proc_fun, auto_add, exclude_filter):
+    def __add_watch(self, path, mask, proc_fun, auto_add, exclude_filter,
+                    pending=None):
         """
         Add a watch on path, build a Watch object and insert it in the
-        watch manager dictionary. Return the wd value.
+        watch manager dictionary. Return the wd value. If pending is a list
+        the (path, wd) entry is appended to it instead of being inserted in
+        the path index, the caller must then index these entries.
         """
         path = self.__format_path(path)
-        if auto_add and not mask & IN_CREATE:
-            mask |= IN_CREATE
         wd = self._inotify_wrapper.inotify_add_watch(self._fd, path, mask)
         if wd < 0:
             return wd
         watch = Watch(wd=wd, path=path, mask=mask, proc_fun=proc_fun,
                       auto_add=auto_add, exclude_filter=exclude_filter)
         # wd are _always_ indexed with their original unicode paths in wmd.
+        old = self._wmd.get(wd)
         self._wmd[wd] = watch
+        if old is not None and old.path != path:
+            # Same inode watched again from another path.
+            self.__unindex_watch()
+        if pending is None:
+            self.__index_watch(watch)
+        else:
+            pending.append((path, wd))
         log.debug('New %s', watch)
         return wd
 
@@ -1901,6 +2451,13 @@ class WatchManager:
         if exclude_filter is None:
             exclude_filter = self._exclude_filter
 
+        if auto_add and not mask & IN_CREATE:
+            mask |= IN_CREATE
+
+        # Bound once, called for every (sub)directory to watch.
+        add_watch_ = self.__add_watch
+        str_errno = self._inotify_wrapper.str_errno
+
         # normalize args as list elements
         for npath in self.__format_param(path):
             # Require that path be a unicode string
@@ -1910,25 +2467,33 @@ class WatchManager:
 
             # unix pathname pattern expansion
             for apath in self.__glob(npath, do_glob):
-                # recursively list subdirs according to rec param
+                # recursively list subdirs according to rec param and
+                # filter them in one pass before adding their watches
+                rpaths = []
                 for rpath in self.__walk_rec(apath, rec):
-                    if not exclude_filter(rpath):
-                        wd = ret_[rpath] = self.__add_watch(rpath, mask,
-                                                            proc_fun,
-                                                            auto_add,
-                                                            exclude_filter)
+                    if exclude_filter(rpath):
+                        # Let's say -2 means 'explicitely excluded
+                        # from watching'.
+                        ret_[rpath] = -2
+                    else:
+                        rpaths.append(rpath)
+
+                # The new watches are inserted at once in the path index.
+                pending = []
+                try:
+                    for rpath in rpaths:
+                        wd = ret_[rpath] = add_watch_(rpath, mask, proc_fun,
+                                                      auto_add, exclude_filter,
+                                                      pending)
                         if wd < 0:
                             err = ('add_watch: cannot watch %s WD=%d, %s' % \
-                                       (rpath, wd,
-                                        self._inotify_wrapper.str_errno()))
+                                       (rpath, wd, str_errno()))
                             if quiet:
                                 log.error(err)
                             else:
                                 raise WatchManagerError(err, ret_)
-                    else:
-                        # Let's say -2 means 'explicitely excluded
-                        # from watching'.
-                        ret_[rpath] = -2
+                finally:
+                    self.__index_watches(pending)
         return ret_
 
     def __get_sub_rec(self, lpath):
@@ -1954,17 +2519,10 @@ class WatchManager:
             if not os.path.isdir(root):
                 continue
 
-            # normalization
-            root = os.path.normpath(root)
-            # recursion
-            lend = len(root)
-            for iwd in self._wmd.items():
-                cur = iwd[1].path
-                pref = os.path.commonprefix([root, cur])
-                if root == os.sep or (len(pref) == lend and \
-                                      len(cur) > lend and \
-                                      cur[lend] == os.sep):
-                    yield iwd[1].wd
+            # recursion, a list is returned thus the caller may remove
+            # watches in between
+            for watch_ in self._get_sub_watches(os.path.normpath(root)):
+                yield watch_.wd
 
     def update_watch(self, wd, mask=None, proc_fun=None, rec=False,
                      auto_add=False, quiet=True):
@@ -2042,20 +2600,24 @@ class WatchManager:
         """
         @param param: Parameter.
         @type param: string or int
-        @return: wrap param.
+        @return: wrap param, param itself if it is already a list.
         @rtype: list of type(param)
         """
         if isinstance(param, list):
-            for p_ in param:
-                yield p_
-        else:
-            yield param
+            return param
+        return [param]
 
     def get_wd(self, path):
         """
-        Returns the watch descriptor associated to path. This method
-        presents a prohibitive cost, always prefer to keep the WD
-        returned by add_watch(). If the path is unknown it returns None.
+        Returns the watch descriptor associated to path. The lookup is
+        done in the path index, in O(log(number of watches)), and the
+        watch found is checked against the watch manager dictionary. If
+        the path is unknown it returns None.
+
+        The path index is only kept in sync with the watches by the
+        WatchManager, Watch.path may only be changed through the
+        WatchManager and must not be assigned directly, otherwise the
+        watch could no longer be found from its new path.
 
         @param path: Path.
         @type path: str
@@ -2063,9 +2625,13 @@ class WatchManager:
         @rtype: int or None
         """
         path = self.__format_path(path)
-        for iwd in self._wmd.items():
-            if iwd[1].path == path:
-                return iwd[0]
+        paths = self._paths
+        i = bisect.bisect_left(paths, (path,))
+        while i < len(paths) and paths[i][0] == path:
+            watch_ = self._wmd.get(paths[i][1])
+            if watch_ is not None and watch_.path == path:
+                return watch_.wd
+            i += 1
 
     def get_path(self, wd):
         """
@@ -2094,9 +2660,26 @@ class WatchManager:
         """
         if not rec or os.path.islink(top) or not os.path.isdir(top):
             yield top
-        else:
+        elif not hasattr(os, 'scandir'):
+            # Python < 3.5
             for root, dirs, files in os.walk(top):
                 yield root
+        else:
+            # Same traversal as os.walk() but only directories are kept and
+            # their type is taken from the directory entries (no stat()).
+            stack = [top]
+            while stack:
+                root = stack.pop()
+                try:
+                    entries = list(os.scandir(root))
+                except OSError:
+                    # Like os.walk(), skip directories that cannot be listed.
+                    continue
+                yield root
+                subdirs = [entry.path for entry in entries
+                           if entry.is_dir(follow_symlinks=False)]
+                subdirs.reverse()
+                stack.extend(subdirs)
 
     def rm_watch(self, wd, rec=False, quiet=True):
         """
@@ -2134,8 +2717,8 @@ class WatchManager:
                 raise WatchManagerError(err, ret_)
 
             # Remove watch from our dictionary
-            if awd in self._wmd:
-                del self._wmd[awd]
+            if self._wmd.pop(awd, None) is not None:
+                self.__unindex_watch()
             ret_[awd] = True
             log.debug('Watch WD=%d (%s) removed', awd, self.get_path(awd))
         return ret_
@@ -2165,17 +2748,15 @@ class WatchManager:
         @return: Same as add_watch().
         @rtype: Same as add_watch().
         """
-        dirname = os.path.dirname(filename)
+        dirname, basename = os.path.split(filename)
         if dirname == '':
             return {}  # Maintains coherence with add_watch()
-        basename = os.path.basename(filename)
         # Assuming we are watching at least for IN_CREATE and IN_DELETE
         mask |= IN_CREATE | IN_DELETE
 
         def cmp_name(event):
-            if getattr(event, 'name') is None:
-                return False
-            return basename == event.name
+            # event.name may be None, it then never equals basename.
+            return event.name == basename
         return self.add_watch(dirname, mask,
                               proc_fun=proc_class(ChainIfTrue(func=cmp_name)),
                               rec=False,
@@ -2202,6 +2783,9 @@ class RawOutputFormat:
     def simple(self, s, attribute):
         if not isinstance(s, str):
             s = str(s)
+        if not self.format:
+            # Nothing to wrap s with.
+            return s
         return (self.format.get(attribute, '') + s +
                 self.format.get('normal', ''))
 
@@ -2256,6 +2840,10 @@ def compatibility_mode():
     for evname in globals():
         if evname.startswith('IN_'):
             setattr(EventsCodes, evname, globals()[evname])
+    # Aliases of maskname and dir, only defined on Event in compatibility
+    # mode.
+    Event.event_name = property(lambda self: self.maskname)
+    Event.is_dir = property(lambda self: self.dir)
     global COMPATIBILITY_MODE
     COMPATIBILITY_MODE = True
 
@@ -2266,6 +2854,7 @@ def command_line():
     monitored. Events monitoring serves forever, type c^c to stop it.
     """
     from optparse import OptionParser
+    import subprocess
 
     usage = "usage: %prog [options] [path1] [path2] [pathn]"
 
@@ -2306,7 +2895,8 @@ def command_line():
     if options.version:
         print(__version__)
 
-    if not options.raw_format:
+    # Escape sequences are only useful when writing to a terminal.
+    if not options.raw_format and sys.stdout.isatty():
         global output_format
         output_format = ColoredOutputFormat()
 
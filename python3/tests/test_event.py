@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# test_event.py - Checks the string representation of events.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+def make_event():
+    return pyinotify.Event({'wd': 1, 'mask': pyinotify.IN_CREATE, 'cookie': 0,
+                            'name': 'foo', 'path': '/tmp', 'dir': False})
+
+
+class EventReprTest(unittest.TestCase):
+
+    def test_repr(self):
+        self.assertEqual(repr(make_event()),
+                         "<Event cookie=0 dir=False mask=0x100 "
+                         "maskname=IN_CREATE name=foo path=/tmp "
+                         "pathname=/tmp/foo wd=1 >")
+
+    def test_compatibility_mode_repr(self):
+        codes = set(vars(pyinotify.EventsCodes))
+        pyinotify.compatibility_mode()
+        try:
+            event = make_event()
+            self.assertEqual(event.event_name, 'IN_CREATE')
+            self.assertEqual(event.is_dir, False)
+            self.assertEqual(str(event),
+                             "<Event cookie=0 dir=False event_name=IN_CREATE "
+                             "is_dir=False mask=0x100 maskname=IN_CREATE "
+                             "name=foo path=/tmp pathname=/tmp/foo wd=1 >")
+        finally:
+            del pyinotify.Event.event_name
+            del pyinotify.Event.is_dir
+            for name in set(vars(pyinotify.EventsCodes)) - codes:
+                delattr(pyinotify.EventsCodes, name)
+            pyinotify.COMPATIBILITY_MODE = False
+
+
+if __name__ == '__main__':
+    unittest.main()
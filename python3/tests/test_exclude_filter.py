@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# test_exclude_filter.py - Checks the matching paths of ExcludeFilter.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+class ExcludeFilterTest(unittest.TestCase):
+
+    def check(self, ef, excluded, kept):
+        # Twice, the second time from the memo.
+        for i in range(2):
+            for path in excluded:
+                self.assertTrue(ef(path), path)
+            for path in kept:
+                self.assertFalse(ef(path), path)
+
+    def test_no_pattern(self):
+        self.check(pyinotify.ExcludeFilter([]), [], ['/etc/hostname'])
+
+    def test_combined(self):
+        ef = pyinotify.ExcludeFilter(['/etc/rc.*', '/etc/hostname$'])
+        self.assertIsNotNone(ef._regex)
+        self.check(ef, ['/etc/rc.d', '/etc/rc2.d/S01foo', '/etc/hostname'],
+                   ['/etc/hostname2', '/etc', '/var/etc/rc.d'])
+
+    def test_groups(self):
+        # Backreferences would be renumbered in a single alternation.
+        ef = pyinotify.ExcludeFilter(['/tmp/(a|b)/\\1$', '/var/log'])
+        self.assertIsNone(ef._regex)
+        self.check(ef, ['/tmp/a/a', '/tmp/b/b', '/var/log/messages'],
+                   ['/tmp/a/b', '/var/lib'])
+
+    def test_flags(self):
+        # The inline flag would apply to every pattern once combined.
+        ef = pyinotify.ExcludeFilter(['(?i)/home/foo', '/home/bar'])
+        self.assertIsNone(ef._regex)
+        self.check(ef, ['/home/foo', '/HOME/FOO/x', '/home/bar'],
+                   ['/HOME/BAR', '/home/baz'])
+
+    def test_memo_reset(self):
+        ef = pyinotify.ExcludeFilter(['/a/', '/b/'])
+        for i in range(8192):
+            ef('/a/%d' % i)
+        self.assertEqual(len(ef._cache), 8192)
+        self.assertFalse(ef('/c/0'))
+        self.assertEqual(ef._cache, {'/c/0': False})
+        self.assertTrue(ef('/a/0'))
+        self.assertEqual(len(ef._cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# test_notifier.py - Checks the event queue of the Notifier.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+class BoundedQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, pyinotify.ProcessEvent(),
+                                           eventq_maxlen=3)
+        self.wm.add_watch(self.tmp, pyinotify.IN_CREATE)
+        # Drops are reported as warnings.
+        self.level = pyinotify.log.level
+        pyinotify.log.setLevel(logging.ERROR)
+
+    def tearDown(self):
+        pyinotify.log.setLevel(self.level)
+        self.notifier.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_read_events(self):
+        for i in range(10):
+            open(os.path.join(self.tmp, str(i)), 'w').close()
+        while self.notifier.check_events(100):
+            self.notifier.read_events()
+        self.assertEqual(len(self.notifier._eventq), 3)
+        self.assertEqual(self.notifier.dropped_events, 7)
+        # The oldest events were dropped.
+        self.assertEqual([raw.name for raw in self.notifier._eventq],
+                         ['7', '8', '9'])
+
+    def test_append_event(self):
+        for i in range(5):
+            self.notifier.append_event(
+                pyinotify._RawEvent(1, pyinotify.IN_CREATE, 0, str(i)))
+        self.assertEqual(len(self.notifier._eventq), 3)
+        self.assertEqual(self.notifier.dropped_events, 2)
+        self.notifier.process_events()
+        self.assertEqual(len(self.notifier._eventq), 0)
+        self.assertEqual(self.notifier.dropped_events, 2)
+
+
+class ReadEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, pyinotify.ProcessEvent())
+        self.wm.add_watch(self.tmp, pyinotify.IN_CREATE)
+
+    def tearDown(self):
+        self.notifier.stop()
+        shutil.rmtree(self.tmp)
+
+    def create(self, count, name_len):
+        for i in range(count):
+            name = str(i).rjust(name_len, 'x')
+            open(os.path.join(self.tmp, name), 'w').close()
+
+    def test_partial_read(self):
+        self.create(10, 8)
+        self.assertTrue(self.notifier.check_events(100))
+        # Everything was read, no need to read again.
+        self.assertFalse(self.notifier.read_events())
+        self.assertEqual(len(self.notifier._eventq), 10)
+
+    def test_full_read(self):
+        # Events of 16 + 208 bytes, more than one buffer.
+        count = pyinotify._READ_SIZE // 224 + 10
+        self.create(count, 200)
+        self.assertTrue(self.notifier.check_events(100))
+        self.assertTrue(self.notifier.read_events())
+        self.assertFalse(self.notifier.read_events())
+        self.assertEqual(len(self.notifier._eventq), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
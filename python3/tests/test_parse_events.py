@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# test_parse_events.py - Checks the C and the Python event parsers agree.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+def raw_event(wd, mask, cookie, name, name_len):
+    return struct.pack('iIII', wd, mask, cookie, name_len) + \
+        name.ljust(name_len, b'\0')
+
+
+class ParseEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parsers = [pyinotify._parse_events_py]
+        c_parser = getattr(pyinotify.inotify_syscalls, 'parse_events', None)
+        if c_parser is not None:
+            self.parsers.append(c_parser)
+        self.buf = (raw_event(1, pyinotify.IN_CREATE, 0, b'foo', 16) +
+                    raw_event(2, pyinotify.IN_DELETE, 7, b'', 0))
+
+    def test_valid_buffer(self):
+        expected = [(1, pyinotify.IN_CREATE, 0, b'foo'),
+                    (2, pyinotify.IN_DELETE, 7, b'')]
+        for parse in self.parsers:
+            self.assertEqual(list(parse(self.buf)), expected)
+
+    def test_truncated_header(self):
+        for parse in self.parsers:
+            self.assertRaises(ValueError, parse, self.buf + b'\0' * 5)
+
+    def test_truncated_name(self):
+        for parse in self.parsers:
+            self.assertRaises(ValueError, parse, self.buf[:10 + 16])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# test_process_event.py - Checks the dispatch of events to process_* methods.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+class Recorder(pyinotify.ProcessEvent):
+
+    def my_init(self):
+        self.calls = []
+
+    def process_IN_CREATE(self, event):
+        self.calls.append(('IN_CREATE', event.mask))
+
+    def process_IN_CLOSE(self, event):
+        self.calls.append(('IN_CLOSE', event.mask))
+
+    def process_default(self, event):
+        self.calls.append(('default', event.mask))
+
+
+def make_event(mask):
+    return pyinotify.Event({'wd': 1, 'mask': mask, 'cookie': 0,
+                            'name': 'foo', 'path': '/tmp'})
+
+
+class ProcessEventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = Recorder()
+
+    def memo(self):
+        return self.proc._ProcessEvent__methods
+
+    def test_dispatch(self):
+        masks = [pyinotify.IN_CREATE,
+                 pyinotify.IN_CREATE | pyinotify.IN_ISDIR,
+                 pyinotify.IN_CLOSE_WRITE,
+                 pyinotify.IN_DELETE | pyinotify.IN_ISDIR]
+        for mask in masks:
+            self.proc(make_event(mask))
+        self.assertEqual(self.proc.calls,
+                         [('IN_CREATE', masks[0]), ('IN_CREATE', masks[1]),
+                          ('IN_CLOSE', masks[2]), ('default', masks[3])])
+
+    def test_memo(self):
+        self.assertIsNone(self.memo())
+        mask = pyinotify.IN_CREATE | pyinotify.IN_ISDIR
+        self.proc(make_event(pyinotify.IN_CREATE))
+        self.proc(make_event(mask))
+        self.assertEqual(self.memo(),
+                         {pyinotify.IN_CREATE: self.proc.process_IN_CREATE,
+                          mask: self.proc.process_IN_CREATE})
+        # Served from the memo afterward.
+        self.proc._lookup_method = None
+        self.proc(make_event(mask))
+        self.assertEqual(self.proc.calls[-1], ('IN_CREATE', mask))
+
+    def test_unknown_mask(self):
+        event = make_event(pyinotify.IN_CREATE)
+        event.mask = 0x00100000
+        self.assertRaises(pyinotify.ProcessEventError, self.proc, event)
+        self.assertEqual(self.memo(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# test_watch_manager.py - Checks the path index of the WatchManager.
+#
+# Run from the python3 directory: python -m unittest discover tests
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import pyinotify
+
+
+class WatchManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for sub in ('a/b/c', 'a/d', 'ab'):
+            os.makedirs(os.path.join(self.tmp, sub))
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, pyinotify.ProcessEvent())
+        self.wm.add_watch(self.tmp, pyinotify.ALL_EVENTS, rec=True)
+
+    def tearDown(self):
+        self.notifier.stop()
+        shutil.rmtree(self.tmp)
+
+    def path(self, sub):
+        return os.path.join(self.tmp, sub)
+
+    def process(self):
+        while self.notifier.check_events(100):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def sub_paths(self, sub):
+        return sorted(w.path for w in self.wm._get_sub_watches(self.path(sub)))
+
+    def test_sub_watches(self):
+        self.assertEqual(self.sub_paths('a'),
+                         [self.path('a/b'), self.path('a/b/c'),
+                          self.path('a/d')])
+        # 'ab' shares a prefix with 'a' but is not located under it.
+        self.assertEqual(self.sub_paths('ab'), [])
+        self.assertEqual(self.sub_paths('a/b/c'), [])
+
+    def test_rm_watch_rec(self):
+        wd = self.wm.get_wd(self.path('a'))
+        ret = self.wm.rm_watch(wd, rec=True)
+        self.assertEqual(len(ret), 4)
+        self.assertTrue(all(ret.values()))
+        for sub in ('a', 'a/b', 'a/b/c', 'a/d'):
+            self.assertIsNone(self.wm.get_wd(self.path(sub)))
+        self.assertEqual(self.sub_paths('a'), [])
+        self.assertIsNotNone(self.wm.get_wd(self.path('ab')))
+        # Watched again, from a fresh state.
+        self.wm.add_watch(self.path('a'), pyinotify.ALL_EVENTS, rec=True)
+        self.assertEqual(len(self.sub_paths('a')), 3)
+
+    def test_rename_tree(self):
+        wds = dict((sub, self.wm.get_wd(self.path(sub)))
+                   for sub in ('a', 'a/b', 'a/b/c', 'a/d'))
+        os.rename(self.path('a'), self.path('z'))
+        self.process()
+        for sub, wd in wds.items():
+            new_sub = 'z' + sub[1:]
+            self.assertIsNone(self.wm.get_wd(self.path(sub)))
+            self.assertEqual(self.wm.get_wd(self.path(new_sub)), wd)
+            self.assertEqual(self.wm.get_path(wd), self.path(new_sub))
+        self.assertIsNotNone(self.wm.get_wd(self.path('ab')))
+        self.assertEqual(self.sub_paths('a'), [])
+        self.assertEqual(self.sub_paths('z'),
+                         [self.path('z/b'), self.path('z/b/c'),
+                          self.path('z/d')])
+
+    def test_get_wd_after_move_back(self):
+        wd = self.wm.get_wd(self.path('a/b'))
+        os.rename(self.path('a'), self.path('z'))
+        self.process()
+        os.rename(self.path('z'), self.path('a'))
+        self.process()
+        self.assertIsNone(self.wm.get_wd(self.path('z/b')))
+        self.assertEqual(self.wm.get_wd(self.path('a/b')), wd)
+        self.assertEqual(len(self.sub_paths('a')), 3)
+
+    def test_get_wd_checks_watch_path(self):
+        wd = self.wm.get_wd(self.path('a/d'))
+        # Not supported, the index is not updated but it is not trusted
+        # either.
+        self.wm.get_watch(wd).path = self.path('a/e')
+        self.assertIsNone(self.wm.get_wd(self.path('a/d')))
+
+
+if __name__ == '__main__':
+    unittest.main()